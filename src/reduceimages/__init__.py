@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+"""Reduce images to share them in social networks.
+
+The engine behind the Nautilus extension. It doesn't depend on GTK nor
+Nautilus, so it can be used from scripts and from the command line
+(`python -m reduceimages`). Only `reduceimages.dialogs`, the GUI of the
+extension, needs GTK."""
+from .config import APP
+from .config import VERSION
+from .config import CONFIG_DIR
+from .config import CONFIG_FILE
+from .config import DEFAULTS
+from .config import read_config
+from .config import write_config
+from .image import open_image
+from .image import reduce_image
+from .manifest import Manifest
+from .reducer import REDUCED
+from .reducer import SKIPPED
+from .reducer import FAILED
+from .reducer import COPIED
+from .reducer import UNCHANGED
+from .reducer import Result
+from .reducer import Reducer
+from .reducer import get_workers
+from .reducer import iter_images
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+"""Archives the reduced images are written into, instead of next to their
+originals.
+
+Every image is encoded in memory by its worker, see `collect`, and
+`Archive.add` appends it to the archive as it arrives, so nothing is
+written twice and only the images in flight are held in memory."""
+import os
+import time
+import tarfile
+import zipfile
+from io import BytesIO
+from .files import commit
+from .files import create_temporary
+from .files import fsync_directory
+from .files import remove_temporary
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar')
+# already compressed, deflating them only costs time
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.avif')
+
+
+def is_archive(filename):
+    return os.path.splitext(filename)[1].lower() in ARCHIVE_EXTENSIONS
+
+
+class Archive(object):
+    """A ZIP or tar file, as the extension of `filename` says.
+
+    It is written to a temporary file that `close` renames over
+    `filename`, so what was there is only replaced by a complete archive.
+    The images are stored flat, by the name of their file, a name already
+    taken gets a number."""
+
+    def __init__(self, filename):
+        if not is_archive(filename):
+            raise ValueError('The archive must be a {0} file: {1}'.format(
+                ' or '.join(ARCHIVE_EXTENSIONS), filename))
+        self.filename = filename
+        fd, self.tmpfile = create_temporary(filename)
+        self.fileobj = os.fdopen(fd, 'wb')
+        self.names = set()
+        self.zip = self.tar = None
+        if filename.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(self.fileobj, 'w', allowZip64=True)
+        else:
+            self.tar = tarfile.open(fileobj=self.fileobj, mode='w|')
+
+    def get_name(self, destFile):
+        """Return the name in the archive of the image for `destFile`."""
+        name = os.path.basename(destFile)
+        root, extension = os.path.splitext(name)
+        number = 1
+        while name in self.names:
+            number += 1
+            name = '{0}-{1}{2}'.format(root, number, extension)
+        self.names.add(name)
+        return name
+
+    def add(self, destFile, data):
+        """Append `data`, the image for `destFile`, and return the name of
+        the image in the archive, as a path under the archive."""
+        name = self.get_name(destFile)
+        if self.zip is not None:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.external_attr = 0o644 << 16
+            if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            self.zip.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0o644
+            self.tar.addfile(info, BytesIO(data))
+        return os.path.join(self.filename, name)
+
+    def close(self):
+        """Finish the archive and put it in place of `filename`."""
+        try:
+            if self.zip is not None:
+                self.zip.close()
+            else:
+                self.tar.close()
+            self.fileobj.flush()
+            os.fsync(self.fileobj.fileno())
+            self.fileobj.close()
+            commit(self.tmpfile, self.filename)
+        except BaseException:
+            self.fileobj.close()
+            remove_temporary(self.tmpfile)
+            raise
+        fsync_directory(os.path.dirname(os.path.abspath(self.filename)))
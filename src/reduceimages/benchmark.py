@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+"""Benchmark of the reduce pipeline.
+
+Generates a deterministic synthetic corpus, reduces it once for every
+combination of settings in MATRIX, encodes it with every encoder setting
+in ENCODERS, makes thumbnails of its JPEG files with and without their
+EXIF thumbnail, resizes it with every resampling tier and saves the
+measures as JSON, so two runs can be compared:
+
+    $ python -m reduceimages.benchmark -o before.json
+    $ python -m reduceimages.benchmark -o after.json --compare before.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import platform
+import argparse
+import resource
+import itertools
+import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing import Process
+from multiprocessing import Queue
+from PIL import Image
+from PIL import ImageDraw
+from PIL import __version__ as PIL_VERSION
+from .config import DEFAULTS
+from .config import RESAMPLING_TIERS
+from .image import get_job
+from .image import encode
+from .image import fit_image
+from .image import open_image
+from .image import reduce_image
+from .image import make_background
+from .image import get_save_params
+from .image import get_output_formats
+
+SEED = 2017
+# name, width, height, format, alpha
+CORPUS = [
+    ('small', 640, 480, 'JPEG', False),
+    ('small', 640, 480, 'PNG', False),
+    ('small', 640, 480, 'PNG', True),
+    ('medium', 2048, 1536, 'JPEG', False),
+    ('medium', 2048, 1536, 'PNG', False),
+    ('medium', 2048, 1536, 'PNG', True),
+    ('camera', 6000, 4000, 'JPEG', False),
+    ('camera', 6000, 4000, 'PNG', True),
+    ('huge', 8660, 5774, 'JPEG', False),
+    ('huge', 8660, 5774, 'PNG', True),
+]
+# the biggest images of the corpus are left out with --quick
+QUICK_PIXELS = 13000000
+MATRIX = OrderedDict([
+    ('width,height', [(1200, 600), (160, 160)]),
+    ('border_width', [0, 20]),
+    ('quality', [60, 80, 95]),
+    ('tojpeg', [True, False]),
+])
+# format, effort (webp_method or avif_speed), from fast to small
+ENCODERS = [
+    ('jpeg', None),
+    ('png', None),
+    ('webp', 0),
+    ('webp', 4),
+    ('webp', 6),
+    ('avif', 10),
+    ('avif', 6),
+    ('avif', 2),
+]
+ENCODER_SIZE = (1200, 600)
+ENCODER_QUALITY = 80
+# box of the thumbnail batch, and longest side of the EXIF thumbnails put
+# in its files, as big as the ones of many cameras
+PREVIEW_BOX = (160, 160)
+PREVIEW_THUMBNAIL = 240
+# boxes the resampling tiers are compared at, and side of the blocks SSIM
+# is computed on
+RESAMPLING_BOXES = [(1200, 600), (160, 160)]
+SSIM_BLOCK = 8
+
+
+def make_image(width, height, alpha, seed):
+    """Return a deterministic photo like image, smooth shapes over a
+    noise texture so it compresses like real pictures do."""
+    rnd = random.Random(seed)
+    image = Image.new('RGB', (width, height),
+                      tuple(rnd.randint(0, 255) for i in range(3)))
+    draw = ImageDraw.Draw(image)
+    for i in range(64):
+        x = rnd.randint(0, width)
+        y = rnd.randint(0, height)
+        r = rnd.randint(min(width, height) // 20, min(width, height) // 3)
+        draw.ellipse((x - r, y - r, x + r, y + r),
+                     fill=tuple(rnd.randint(0, 255) for i in range(3)))
+    tile = Image.frombytes('L', (256, 256), bytes(bytearray(
+        rnd.getrandbits(8) for i in range(256 * 256))))
+    noise = Image.new('L', (width, height))
+    for x in range(0, width, 256):
+        for y in range(0, height, 256):
+            noise.paste(tile, (x, y))
+    image = Image.blend(image, Image.merge('RGB', (noise, noise, noise)),
+                        0.12)
+    if alpha is True:
+        mask = Image.radial_gradient('L').resize((width, height))
+        image.putalpha(mask.point(lambda value: 255 - value))
+    return image
+
+
+def make_corpus(directory, quick=False):
+    """Create the corpus in `directory`, reusing the files already there,
+    and return the list of its files."""
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    files = []
+    for index, (name, width, height, format, alpha) in enumerate(CORPUS):
+        if quick is True and width * height > QUICK_PIXELS:
+            continue
+        filename = os.path.join(directory, '{0}-{1}x{2}{3}.{4}'.format(
+            name, width, height, '-alpha' if alpha else '',
+            'jpg' if format == 'JPEG' else 'png'))
+        if not os.path.exists(filename):
+            image = make_image(width, height, alpha, SEED + index)
+            image.save(filename, format, quality=92)
+        files.append(filename)
+    return files
+
+
+def make_exif(thumbnail, orientation=1):
+    """Return an EXIF block with `orientation` and the JPEG data
+    `thumbnail` in IFD1, as cameras write it."""
+    ifd1 = 8 + 18
+    data = ifd1 + 30
+    tiff = b'II*\x00' + struct.pack('<I', 8)
+    tiff += struct.pack('<H', 1) + \
+        struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0) + \
+        struct.pack('<I', ifd1)
+    tiff += struct.pack('<H', 2) + \
+        struct.pack('<HHII', 0x0201, 4, 1, data) + \
+        struct.pack('<HHII', 0x0202, 4, 1, len(thumbnail)) + \
+        struct.pack('<I', 0)
+    return b'Exif\x00\x00' + tiff + thumbnail
+
+
+def make_previews(files, directory):
+    """Copy the JPEG files in `files` to `directory` with an EXIF
+    thumbnail, every other one rotated, and return the copies."""
+    copies = []
+    for index, afile in enumerate(files):
+        if not afile.lower().endswith('.jpg'):
+            continue
+        filename = os.path.join(directory, 'preview-' + os.path.basename(
+            afile))
+        if not os.path.exists(filename):
+            image = Image.open(afile)
+            thumbnail = image.copy()
+            thumbnail.thumbnail((PREVIEW_THUMBNAIL, PREVIEW_THUMBNAIL),
+                                Image.LANCZOS)
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, 'JPEG', quality=85)
+            image.save(filename, 'JPEG', quality=92, exif=make_exif(
+                buffer.getvalue(), 6 if index % 2 else 1))
+        copies.append(filename)
+    return copies
+
+
+def get_combinations():
+    keys = list(MATRIX.keys())
+    for values in itertools.product(*MATRIX.values()):
+        options = DEFAULTS.copy()
+        for key, value in zip(keys, values):
+            if ',' in key:
+                options.update(zip(key.split(','), value))
+            else:
+                options[key] = value
+        options['overwrite'] = False
+        yield options
+
+
+def get_percentile(values, percentile):
+    """Nearest rank percentile of the sorted list `values`."""
+    if not values:
+        return 0.0
+    rank = int(round(percentile / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def timed_job(job):
+    """Reduce one file and return its (seconds, output size)."""
+    start = time.time()
+    destFile = reduce_image(*job)
+    seconds = time.time() - start
+    size = os.path.getsize(destFile)
+    os.remove(destFile)
+    return seconds, size
+
+
+def measure(files, options, workers, results):
+    """Reduce `files` with `options`, this runs in a process of its own
+    so peak RSS belongs to this combination only."""
+    jobs = [get_job(afile, options) for afile in files]
+    start = time.time()
+    if workers > 1:
+        pool = Pool(workers)
+        timings = pool.map(timed_job, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        timings = [timed_job(job) for job in jobs]
+    seconds = time.time() - start
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    results.put((seconds, timings, rss))
+
+
+def run_combination(files, options, workers):
+    results = Queue()
+    process = Process(target=measure, args=(files, options, workers,
+                                            results))
+    process.start()
+    seconds, timings, rss = results.get()
+    process.join()
+    latencies = sorted(timing[0] for timing in timings)
+    input_bytes = sum(os.path.getsize(afile) for afile in files)
+    return OrderedDict([
+        ('settings', OrderedDict((key, options[key]) for key in (
+            'width', 'height', 'border_width', 'quality', 'tojpeg'))),
+        ('images', len(files)),
+        ('seconds', seconds),
+        ('images_per_s', len(files) / seconds),
+        ('mb_per_s', input_bytes / 1048576.0 / seconds),
+        ('latency_ms', OrderedDict(
+            ('p{0}'.format(percentile),
+             1000.0 * get_percentile(latencies, percentile))
+            for percentile in (50, 90, 99, 100))),
+        # ru_maxrss is in kilobytes on Linux
+        ('peak_rss_mb', rss / 1024.0),
+        ('input_bytes', input_bytes),
+        ('output_bytes', sum(timing[1] for timing in timings)),
+    ])
+
+
+def measure_encoders(files, encoders=ENCODERS):
+    """Return the encode time and output size of every encoder in
+    `encoders` that this Pillow has, over `files` reduced to
+    ENCODER_SIZE. Only the encode is timed."""
+    available = get_output_formats()
+    images = []
+    for afile in files:
+        image = open_image(afile, ENCODER_SIZE)
+        image.thumbnail(ENCODER_SIZE, Image.LANCZOS)
+        images.append(make_background(image, ENCODER_SIZE[0],
+                                      ENCODER_SIZE[1], 0, '#000000'))
+    results = []
+    for format, effort in encoders:
+        if format not in available:
+            continue
+        params = get_save_params(format.upper(), effort, effort)
+        seconds = 0.0
+        output_bytes = 0
+        for image in images:
+            if format == 'jpeg':
+                image = image.convert('RGB')
+            start = time.time()
+            data = encode(image, format.upper(), ENCODER_QUALITY, params)
+            seconds += time.time() - start
+            output_bytes += len(data)
+        results.append(OrderedDict([
+            ('format', format),
+            ('effort', effort),
+            ('quality', ENCODER_QUALITY),
+            ('images', len(images)),
+            ('encode_ms', 1000.0 * seconds / len(images)),
+            ('output_kb', output_bytes / 1024.0 / len(images)),
+        ]))
+    return results
+
+
+def measure_previews(files):
+    """Return the throughput of making PREVIEW_BOX thumbnails of `files`
+    from the whole image and from their EXIF thumbnail."""
+    results = []
+    for preview in (False, True):
+        options = DEFAULTS.copy()
+        options.update(width=PREVIEW_BOX[0], height=PREVIEW_BOX[1],
+                       overwrite=False, preview=preview)
+        start = time.time()
+        for afile in files:
+            timed_job(get_job(afile, options))
+        seconds = time.time() - start
+        results.append(OrderedDict([
+            ('preview', preview),
+            ('images', len(files)),
+            ('seconds', seconds),
+            ('images_per_s', len(files) / seconds),
+        ]))
+    return results
+
+
+def get_ssim(image1, image2, block=SSIM_BLOCK):
+    """Return the mean SSIM of the luminance of two images, over blocks of
+    `block` pixels. `image2` is resized to `image1` if they differ."""
+    if image2.size != image1.size:
+        image2 = image2.resize(image1.size, Image.BICUBIC)
+    width, height = image1.size
+    x = list(image1.convert('L').getdata())
+    y = list(image2.convert('L').getdata())
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    n = float(block * block)
+    total = 0.0
+    count = 0
+    for top in range(0, height - block + 1, block):
+        for left in range(0, width - block + 1, block):
+            sx = sy = sxx = syy = sxy = 0
+            for row in range(top, top + block):
+                start = row * width + left
+                for a, b in zip(x[start:start + block],
+                                y[start:start + block]):
+                    sx += a
+                    sy += b
+                    sxx += a * a
+                    syy += b * b
+                    sxy += a * b
+            mx = sx / n
+            my = sy / n
+            vx = sxx / n - mx * mx
+            vy = syy / n - my * my
+            cov = sxy / n - mx * my
+            total += ((2 * mx * my + c1) * (2 * cov + c2)) / \
+                ((mx * mx + my * my + c1) * (vx + vy + c2))
+            count += 1
+    return total / count if count else 1.0
+
+
+def measure_resamplings(files, boxes=RESAMPLING_BOXES):
+    """Return the throughput of every resampling tier reducing `files` to
+    fit in every box of `boxes`, and the SSIM of what it makes against
+    'best'."""
+    results = []
+    for box in boxes:
+        references = [fit_image(afile, box, 'best') for afile in files]
+        for tier in RESAMPLING_TIERS:
+            start = time.time()
+            images = [fit_image(afile, box, tier) for afile in files]
+            seconds = time.time() - start
+            ssims = [get_ssim(reference, image)
+                     for reference, image in zip(references, images)]
+            results.append(OrderedDict([
+                ('box', box),
+                ('resampling', tier),
+                ('images', len(files)),
+                ('seconds', seconds),
+                ('images_per_s', len(files) / seconds),
+                ('ssim_mean', sum(ssims) / len(ssims)),
+                ('ssim_min', min(ssims)),
+            ]))
+    return results
+
+
+def write_resamplings(results, out=sys.stderr):
+    out.write('{0:<10} {1:<10} {2:>8} {3:>10} {4:>10}\n'.format(
+        'box', 'resampling', 'img/s', 'SSIM mean', 'SSIM min'))
+    for result in results:
+        out.write('{0:<10} {1:<10} {2:>8.2f} {3:>10.4f} {4:>10.4f}\n'.format(
+            '{0}x{1}'.format(*result['box']), result['resampling'],
+            result['images_per_s'], result['ssim_mean'], result['ssim_min']))
+
+
+def get_key(result):
+    return json.dumps(result['settings'], sort_keys=True)
+
+
+def compare(base, current, out=sys.stdout):
+    """Print the speed up of every combination in `current` over
+    `base`."""
+    base = dict((get_key(result), result) for result in base['results'])
+    out.write('{0:<64} {1:>9} {2:>9} {3:>9}\n'.format(
+        'settings', 'img/s', 'p90 ms', 'rss MB'))
+    for result in current['results']:
+        old = base.get(get_key(result))
+        if old is None:
+            continue
+        out.write('{0:<64} {1:>8.2f}x {2:>8.2f}x {3:>8.2f}x\n'.format(
+            ' '.join('{0}={1}'.format(key, value)
+                     for key, value in result['settings'].items()),
+            result['images_per_s'] / old['images_per_s'],
+            result['latency_ms']['p90'] / old['latency_ms']['p90'],
+            result['peak_rss_mb'] / old['peak_rss_mb']))
+
+
+def write_encoders(results, out=sys.stderr):
+    out.write('{0:<8} {1:>6} {2:>10} {3:>10}\n'.format(
+        'format', 'effort', 'encode ms', 'KB'))
+    for result in results:
+        out.write('{0:<8} {1:>6} {2:>10.1f} {3:>10.1f}\n'.format(
+            result['format'], '-' if result['effort'] is None
+            else result['effort'], result['encode_ms'], result['output_kb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='reduceimages.benchmark',
+                                     description='Benchmark reduce_image.')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        default='benchmark.json',
+                        help='save the results as JSON in FILE')
+    parser.add_argument('--corpus', metavar='DIR',
+                        help='keep the generated corpus in DIR')
+    parser.add_argument('--quick', action='store_true',
+                        help='leave out the images over {0} MP'.format(
+                            QUICK_PIXELS // 1000000))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes (default: 1)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a previous run')
+    args = parser.parse_args(argv)
+
+    directory = args.corpus or tempfile.mkdtemp(prefix='reduceimages-')
+    try:
+        files = make_corpus(directory, args.quick)
+        results = []
+        for options in get_combinations():
+            result = run_combination(files, options, args.workers)
+            results.append(result)
+            sys.stderr.write('{0} {1:.2f} img/s {2:.2f} MB/s\n'.format(
+                dict(result['settings']), result['images_per_s'],
+                result['mb_per_s']))
+        encoders = measure_encoders(files)
+        write_encoders(encoders)
+        previews = measure_previews(make_previews(files, directory))
+        sys.stderr.write('thumbnails {0:.2f} img/s, from the EXIF thumbnail '
+                         '{1:.2f} img/s, {2:.1f}x\n'.format(
+                             previews[0]['images_per_s'],
+                             previews[1]['images_per_s'],
+                             previews[1]['images_per_s'] /
+                             previews[0]['images_per_s']))
+        resamplings = measure_resamplings(files)
+        write_resamplings(resamplings)
+    finally:
+        if args.corpus is None:
+            shutil.rmtree(directory)
+    report = OrderedDict([
+        ('meta', OrderedDict([
+            ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('python', platform.python_version()),
+            ('pillow', PIL_VERSION),
+            ('platform', platform.platform()),
+            ('workers', args.workers),
+            ('seed', SEED),
+            ('corpus', [os.path.basename(afile) for afile in files]),
+        ])),
+        ('results', results),
+        ('encoders', encoders),
+        ('previews', previews),
+        ('resamplings', resamplings),
+    ])
+    with open(args.output, 'w') as fw:
+        json.dump(report, fw, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as fr:
+            compare(json.load(fr), report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import sys
+import json
+import argparse
+from .config import APP
+from .config import VERSION
+from .config import DEFAULTS
+from .config import read_config
+from .config import parse_rendition
+from .config import RESAMPLING_TIERS
+from .image import get_output_formats
+from .archive import is_archive
+from .archive import ARCHIVE_EXTENSIONS
+from .reducer import FAILED
+from .reducer import Reducer
+from .daemon import RemoteReducer
+from .watch import watch
+from .reducer import iter_images
+from .progress import Progress
+from .progress import format_summary
+from .profiling import ProfileLog
+from .profiling import get_profile_file
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='reduceimages',
+        description='Reduce images to share them in social networks. '
+                    'Prints a JSON line for every file.')
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help='image files or directories')
+    parser.add_argument('--version', action='version',
+                        version='{0} {1}'.format(APP, VERSION))
+    parser.add_argument('-c', '--config', metavar='FILE',
+                        help='read the settings from FILE, by default they '
+                             'are only read with --watch, from the saved '
+                             'ones')
+    parser.add_argument('--no-recursive', dest='recursive',
+                        action='store_false',
+                        help='do not descend into subdirectories')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep reducing the images written to the PATH '
+                             'directories, or to the watch_dirs setting, '
+                             'until interrupted')
+    group = parser.add_argument_group('settings',
+                                      'override the settings of --config')
+    group.add_argument('--rendition', dest='renditions', action='append',
+                       metavar='NAME:WxH[:QUALITY[:FORMAT[:BORDER]]]',
+                       help='write this rendition, can be repeated. FORMAT '
+                            'is jpeg, png, webp, avif or original')
+    for key, value in DEFAULTS.items():
+        flag = '--' + key.replace('_', '-')
+        if isinstance(value, list):
+            continue
+        elif isinstance(value, bool):
+            group.add_argument(flag, dest=key, action='store_true',
+                               default=None)
+            group.add_argument('--no-' + key.replace('_', '-'), dest=key,
+                               action='store_false', default=None)
+        else:
+            group.add_argument(flag, dest=key, type=type(value),
+                               metavar=key.upper(), default=None)
+    return parser
+
+
+def get_options(args):
+    if args.config is not None:
+        options = read_config(args.config)
+    elif args.watch is True:
+        # like a Nautilus window, a watcher is set up once
+        options = read_config()
+    else:
+        options = DEFAULTS.copy()
+    for key in DEFAULTS.keys():
+        if getattr(args, key) is not None:
+            options[key] = getattr(args, key)
+    if args.renditions is not None:
+        options['renditions'] = [parse_rendition(text, options)
+                                 for text in args.renditions]
+    if options['resampling'] not in RESAMPLING_TIERS:
+        raise ValueError('Invalid resampling {0}, it must be one of '
+                         '{1}'.format(options['resampling'],
+                                      ', '.join(RESAMPLING_TIERS)))
+    if options['archive'] and not is_archive(options['archive']):
+        raise ValueError('The archive must be a {0} file'.format(
+            ' or '.join(ARCHIVE_EXTENSIONS)))
+    if options['archive']:
+        directory = os.path.dirname(os.path.abspath(options['archive']))
+        if not os.path.isdir(directory):
+            raise ValueError('No directory {0} for the archive'.format(
+                directory))
+        if not os.access(directory, os.W_OK | os.X_OK):
+            raise ValueError('The archive can not be written to {0}'.format(
+                directory))
+    available = get_output_formats() + ['original']
+    for format in [options['format']] + [rendition['format'] for rendition
+                                         in options['renditions']]:
+        if format and format not in available:
+            raise ValueError('No {0} encoder, the formats available are '
+                             '{1}'.format(format, ', '.join(available)))
+    return options
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    try:
+        options = get_options(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.watch is True:
+        directories = args.paths or [
+            directory for directory in options['watch_dirs'].split(os.pathsep)
+            if directory]
+        if not directories:
+            parser.error('no directories to watch')
+        if options['archive']:
+            parser.error('--watch can not write to an archive')
+        results = watch(directories, options, args.recursive)
+    elif not args.paths:
+        parser.error('the following arguments are required: PATH')
+    elif options['daemon'] is True:
+        results = RemoteReducer(options).run(
+            iter_images(args.paths, args.recursive))
+    else:
+        results = Reducer(options).run(iter_images(args.paths,
+                                                   args.recursive))
+    progress = Progress()
+    profile = None
+    if get_profile_file(options) is not None:
+        profile = ProfileLog(get_profile_file(options))
+    try:
+        for result in results:
+            progress.add(result)
+            if profile is not None:
+                profile.add(result)
+            sys.stdout.write(json.dumps(result._asdict()) + '\n')
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        if args.watch is False:
+            return 130
+    finally:
+        if profile is not None:
+            profile.close()
+    snapshot = progress.snapshot()
+    sys.stderr.write(format_summary(snapshot) + '\n')
+    if profile is not None:
+        sys.stderr.write(profile.summary() + '\n')
+    return 1 if snapshot['counts'].get(FAILED, 0) > 0 else 0
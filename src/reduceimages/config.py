@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import re
+import sys
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+from collections import OrderedDict
+
+APP = '$APP$'
+VERSION = '$VERSION$'
+
+CONFIG_DIR = os.path.join(os.path.expanduser('~'), '.config', APP.lower())
+CONFIG_FILE = os.path.join(CONFIG_DIR, '{0}.conf'.format(APP.lower()))
+
+DEFAULTS = OrderedDict([
+    ('width', 1200),
+    ('height', 600),
+    ('border_width', 0),
+    ('color', '#000000'),
+    ('quality', 80),
+    ('tojpeg', True),
+    # jpeg, png, webp or avif overrides tojpeg, see get_output_formats
+    ('format', ''),
+    # encoder effort, see get_save_params
+    ('webp_method', 4),
+    ('avif_speed', 6),
+    ('overwrite', True),
+    # a .zip or .tar file to write the images into instead, see archive.py
+    ('archive', ''),
+    ('max_kb', 0),
+    ('workers', 0),
+    ('memory_mb', 0),
+    ('max_megapixels', 250),
+    ('cache', True),
+    ('cache_hash', False),
+    # JPEG files that already fit are not reduced again, see get_action
+    ('probe', True),
+    # files with the same content are reduced once, see Duplicates
+    ('dedupe', True),
+    # small sizes are made from the EXIF thumbnail when it is big enough
+    ('preview', False),
+    # time the stages of every image, see profiling.py
+    ('profile', False),
+    # fast, balanced or best, see RESAMPLINGS
+    ('resampling', 'balanced'),
+    # run the jobs in the daemon shared by every window, see daemon.py
+    ('daemon', False),
+    # directories watched by `reduceimages --watch`, separated by ':', and
+    # seconds a file that is not closed must be left alone to be reduced
+    ('watch_dirs', ''),
+    ('quiet_seconds', 10),
+    # named renditions, see parse_rendition. They are saved in sections
+    # of their own, '[Rendition <name>]'
+    ('renditions', []),
+])
+RENDITION_FORMATS = ('jpeg', 'png', 'webp', 'avif', 'original')
+RENDITION_NAME = re.compile(r'^[\w-]+$')
+RESAMPLING_TIERS = ('fast', 'balanced', 'best')
+
+
+def make_rendition(name, options, width=None, height=None, quality=None,
+                   format=None, border_width=None):
+    """Return a rendition, what isn't given is taken from `options`."""
+    if RENDITION_NAME.match(name) is None:
+        raise ValueError('Invalid rendition name: {0}'.format(name))
+    if format is None:
+        format = options.get('format') or (
+            'jpeg' if options['tojpeg'] is True else 'original')
+    if format not in RENDITION_FORMATS:
+        raise ValueError('Invalid rendition format: {0}'.format(format))
+    return OrderedDict([
+        ('name', name),
+        ('width', options['width'] if width is None else int(width)),
+        ('height', options['height'] if height is None else int(height)),
+        ('quality', options['quality'] if quality is None else int(quality)),
+        ('format', format),
+        ('border_width', options['border_width'] if border_width is None
+         else int(border_width)),
+    ])
+
+
+def parse_rendition(text, options=DEFAULTS):
+    """Return the rendition of `text`,
+    'name:WIDTHxHEIGHT[:quality[:format[:border_width]]]'."""
+    fields = [field.strip() or None for field in text.strip().split(':')]
+    if len(fields) < 2 or fields[0] is None or fields[1] is None or \
+            len(fields) > 5:
+        raise ValueError('Invalid rendition: {0}'.format(text))
+    try:
+        width, height = fields[1].lower().split('x')
+    except ValueError:
+        raise ValueError('Invalid rendition size: {0}'.format(fields[1]))
+    fields += [None] * (5 - len(fields))
+    return make_rendition(fields[0], options, width, height, fields[2],
+                          fields[3], fields[4])
+
+
+def format_rendition(rendition):
+    return '{name}:{width}x{height}:{quality}:{format}:{border_width}'.format(
+        **rendition)
+
+
+def read_config(filename=CONFIG_FILE):
+    config = ConfigParser.ConfigParser()
+    config.read(filename)
+    options = DEFAULTS.copy()
+    if not config.has_section('Config'):
+        write_config(filename)
+        return options
+    for key, value in DEFAULTS.items():
+        if isinstance(value, list):
+            continue
+        try:
+            if isinstance(value, bool):
+                options[key] = config.getboolean('Config', key)
+            elif isinstance(value, int):
+                options[key] = config.getint('Config', key)
+            else:
+                options[key] = config.get('Config', key)
+        except ConfigParser.NoOptionError:
+            # saved by an older version, the default stands
+            pass
+        except ValueError as e:
+            sys.stderr.write('{0}\n'.format(e))
+    if options['resampling'] not in RESAMPLING_TIERS:
+        sys.stderr.write('Invalid resampling: {0}\n'.format(
+            options['resampling']))
+        options['resampling'] = DEFAULTS['resampling']
+    options['renditions'] = []
+    for section in config.sections():
+        if not section.startswith('Rendition '):
+            continue
+        values = dict(config.items(section))
+        try:
+            options['renditions'].append(make_rendition(
+                section[len('Rendition '):], options, values.get('width'),
+                values.get('height'), values.get('quality'),
+                values.get('format'), values.get('border_width')))
+        except ValueError as e:
+            sys.stderr.write('{0}\n'.format(e))
+    return options
+
+
+def makedirs(directory):
+    """Create `directory`, the config dir is only created when something
+    has to be saved there."""
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+
+def write_config(filename=CONFIG_FILE, **options):
+    makedirs(os.path.dirname(filename))
+    config = ConfigParser.ConfigParser()
+    config.add_section('Config')
+    for key, value in DEFAULTS.items():
+        if not isinstance(value, list):
+            config.set('Config', key, str(options.get(key, value)))
+    for rendition in options.get('renditions', []):
+        section = 'Rendition {0}'.format(rendition['name'])
+        config.add_section(section)
+        for key, value in rendition.items():
+            if key != 'name':
+                config.set(section, key, str(value))
+    with open(filename, 'w') as configfile:
+        config.write(configfile)
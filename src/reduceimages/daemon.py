@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+"""Daemon that runs the jobs of every Nautilus window and of the command
+line in one warm pool of workers.
+
+Clients talk to it over a Unix socket with JSON lines. A job is a single
+line, {"options": {...}, "files": [...]}, and the daemon answers with a
+`Result` per line, as `Reducer.run` yields them, or with
+{"error": "..."} if the job fails as a whole. Closing the connection,
+or sending any other line, cancels the job. Every job has a `Reducer` of
+its own over the shared pool, budget and manifest. A job never has more
+than `workers * JOBS_PER_WORKER` files queued in the pool, and the pool
+runs them in order, so jobs at once take turns.
+
+The daemon is started by the first `RemoteReducer` that can't reach it,
+and quits after IDLE_TIMEOUT seconds without jobs:
+
+    $ python -m reduceimages.daemon
+"""
+import os
+import sys
+import json
+import fcntl
+import time
+import signal
+import socket
+import argparse
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+from collections import OrderedDict
+from threading import Lock
+from threading import Thread
+from .config import APP
+from .config import CONFIG_DIR
+from .config import makedirs
+from .config import read_config
+from .manifest import Manifest
+from .reducer import Budget
+from .reducer import Result
+from .reducer import Reducer
+from .reducer import make_pool
+from .reducer import close_pool
+from .reducer import get_max_pixels
+from .reducer import get_python
+from .reducer import get_workers
+from .reducer import get_memory_budget
+from .profiling import is_profiling
+
+SOCKET_FILE = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or CONFIG_DIR,
+                           '{0}.sock'.format(APP.lower()))
+IDLE_TIMEOUT = 300
+# seconds a client waits for the daemon it started
+START_TIMEOUT = 10
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def send(self, message):
+        """Send `message` to the client, False if it is gone."""
+        try:
+            self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+            self.wfile.flush()
+        except (IOError, OSError) as e:
+            sys.stderr.write('{0}\n'.format(e))
+            return False
+        return True
+
+    def handle(self):
+        self.server.begin()
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'),
+                                 object_pairs_hook=OrderedDict)
+            reducer = self.server.get_reducer(request['options'])
+            watcher = Thread(target=self.watch, args=(reducer,))
+            watcher.daemon = True
+            watcher.start()
+            results = reducer.run(request['files'])
+            for result in results:
+                if not self.send(result._asdict()):
+                    reducer.stop()
+                    results.close()
+                    break
+        except Exception as e:
+            # tell the client, else it would take it for a job done
+            sys.stderr.write('{0}\n'.format(e))
+            self.send({'error': str(e) or e.__class__.__name__})
+        finally:
+            self.server.end()
+
+    def watch(self, reducer):
+        """Stop `reducer` as soon as its client cancels."""
+        # from the socket, a read of rfile would hold its lock and block
+        # closing it when the job is done
+        try:
+            self.request.recv(1)
+        except (IOError, OSError):
+            pass
+        reducer.stop()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # seconds handle_request waits, to check for idleness meanwhile
+    timeout = 1.0
+
+    def __init__(self, filename=SOCKET_FILE, options=None,
+                 idle_timeout=IDLE_TIMEOUT):
+        if options is None:
+            options = read_config()
+        self.idle_timeout = idle_timeout
+        self.workers = get_workers(options.get('workers', 0))
+        # the pool is forked before any thread is started
+        self.pool = make_pool(self.workers, get_max_pixels(options))
+        self.budget = Budget(get_memory_budget(options.get('memory_mb', 0)))
+        self.manifest = Manifest(use_digest=options.get('cache_hash'))
+        self.jobs = 0
+        self.last = time.time()
+        self.lock = Lock()
+        makedirs(os.path.dirname(filename))
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, filename, Handler)
+        finally:
+            os.umask(umask)
+
+    def get_reducer(self, options):
+        return Reducer(options, self.workers, self.pool, self.budget,
+                       self.manifest)
+
+    def begin(self):
+        with self.lock:
+            self.jobs += 1
+
+    def end(self):
+        with self.lock:
+            self.jobs -= 1
+            self.last = time.time()
+
+    def is_idle(self):
+        with self.lock:
+            return self.jobs == 0 and \
+                time.time() - self.last > self.idle_timeout
+
+    def serve(self):
+        """Serve jobs until idle."""
+        try:
+            while not self.is_idle():
+                self.handle_request()
+        finally:
+            self.server_close()
+            close_pool(self.pool)
+            self.manifest.save()
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address)
+
+
+def connect_socket(filename=SOCKET_FILE):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(filename)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def spawn():
+    """Start the daemon detached from this process, OSError if it can't
+    be run."""
+    python = get_python()
+    if python is None:
+        raise OSError('No python{0}.{1} to start the daemon with'.format(
+            *sys.version_info[:2]))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    # closed on exec, so it is only written to if the exec fails
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid > 0:
+        os.close(writer)
+        os.waitpid(pid, 0)
+        try:
+            failed = os.read(reader, 1)
+        finally:
+            os.close(reader)
+        if failed:
+            raise OSError('Could not run {0}'.format(python))
+        return
+    # never go back to the caller, this is a copy of it, Nautilus maybe
+    try:
+        os.close(reader)
+        fcntl.fcntl(writer, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+        os.chdir('/')
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        try:
+            os.execve(python, [python, '-m', __name__], env)
+        except OSError:
+            os.write(writer, b'x')
+    finally:
+        os._exit(127)
+
+
+def connect(filename=SOCKET_FILE):
+    """Return a socket connected to the daemon, starting it if it isn't
+    running. socket.error or OSError if it can't."""
+    try:
+        return connect_socket(filename)
+    except socket.error:
+        spawn()
+    deadline = time.time() + START_TIMEOUT
+    while True:
+        try:
+            return connect_socket(filename)
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class RemoteReducer(object):
+    """Runs the jobs of `options` in the daemon, with the interface of
+    `Reducer`. If the daemon can't be reached they run here."""
+
+    def __init__(self, options, workers=0, filename=SOCKET_FILE):
+        self.options = options
+        self.workers = workers
+        self.filename = filename
+        self.reducer = None
+        self.stopit = False
+
+    def stop(self, *args):
+        self.stopit = True
+        if self.reducer is not None:
+            self.reducer.stop()
+
+    def run(self, elements):
+        """Yield a `Result` for every file in `elements` as the daemon
+        sends them. RuntimeError if the daemon reports the job failed, or
+        goes away before every file is done."""
+        # the daemon has a working directory of its own
+        elements = [os.path.abspath(element) for element in elements]
+        try:
+            sock = connect(self.filename)
+        except (socket.error, OSError) as e:
+            sys.stderr.write('{0}\n'.format(e))
+            self.reducer = Reducer(self.options, self.workers)
+            if self.stopit is True:
+                self.reducer.stop()
+            for result in self.reducer.run(elements):
+                yield result
+            return
+        try:
+            # the environment and the working directory of the daemon may
+            # not be these ones
+            options = dict(self.options, profile=is_profiling(self.options))
+            if options.get('archive'):
+                options['archive'] = os.path.abspath(options['archive'])
+            sock.sendall((json.dumps({'options': options,
+                                      'files': elements}) +
+                          '\n').encode('utf-8'))
+            # wake up every now and then to see if stopped
+            sock.settimeout(0.2)
+            buffer = b''
+            done = 0
+            while self.stopit is False:
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                buffer += data
+                lines = buffer.split(b'\n')
+                buffer = lines.pop()
+                for line in lines:
+                    message = json.loads(line.decode('utf-8'))
+                    if 'source' not in message:
+                        raise RuntimeError('The daemon failed: {0}'.format(
+                            message['error']))
+                    done += 1
+                    yield Result(**message)
+            if self.stopit is False and done < len(elements):
+                raise RuntimeError('The daemon quit with {0} of {1} files '
+                                   'done'.format(done, len(elements)))
+        finally:
+            sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='reduceimages.daemon',
+        description='Run the jobs of every client in one pool of workers.')
+    parser.add_argument('--socket', metavar='FILE', default=SOCKET_FILE,
+                        help='listen on FILE (default: %(default)s)')
+    parser.add_argument('--idle-timeout', type=int, default=IDLE_TIMEOUT,
+                        metavar='SECONDS',
+                        help='quit after SECONDS without jobs '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    if os.path.exists(args.socket):
+        try:
+            connect_socket(args.socket).close()
+            # already running
+            return 0
+        except socket.error:
+            os.remove(args.socket)
+    # quit cleanly, so the workers are not left behind
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    Server(args.socket, idle_timeout=args.idle_timeout).serve()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,697 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+"""GTK dialogs and the background thread of the Nautilus extension.
+
+This is the only module of the package that needs GTK, the extension
+imports it the first time it is used."""
+import gi
+try:
+    gi.require_version('Gtk', '3.0')
+    gi.require_version('Gdk', '3.0')
+    gi.require_version('GObject', '2.0')
+    gi.require_version('GLib', '2.0')
+except Exception as e:
+    print(e)
+    exit(-1)
+from gi.repository import Gtk
+from gi.repository import Gdk
+from gi.repository import GObject
+from gi.repository import GLib
+import os
+from threading import Lock
+from threading import Thread
+from .config import APP
+from .config import VERSION
+from .config import read_config
+from .config import write_config
+from .config import parse_rendition
+from .config import format_rendition
+from .config import RESAMPLING_TIERS
+from .image import get_output_formats
+from .archive import is_archive
+from .archive import ARCHIVE_EXTENSIONS
+from .reducer import FAILED
+from .reducer import SKIPPED
+from .reducer import Reducer
+from .reducer import is_embedded
+from .reducer import get_pool_context
+from .daemon import RemoteReducer
+from .progress import Progress
+from .progress import format_progress
+from .progress import format_summary
+from .profiling import ProfileLog
+from .profiling import get_profile_file
+
+MARGIN = 10
+# the dialog is refreshed at most once every REFRESH_INTERVAL ms, however
+# fast the images are reduced
+REFRESH_INTERVAL = 250
+
+_ = str
+
+
+def rgba_to_hex(color):
+    """Return hexadecimal string for :class:`Gdk.RGBA` `color`."""
+    return '#{0:02x}{1:02x}{2:02x}'.format(int(color.red * 255),
+                                           int(color.green * 255),
+                                           int(color.blue * 255))
+
+
+def hex_to_rgba(hex):
+    """Return Gdk.RGBA color from hex string."""
+    color = Gdk.RGBA()
+    try:
+        color.parse(hex)
+        return color
+    except Exception as e:
+        print(e)
+    color.parse('#000000')
+    return color
+
+
+class ProgressDialog(Gtk.Dialog):
+    __gsignals__ = {
+        'i-want-stop': (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, ()),
+    }
+
+    def __init__(self, title, parent, max_value):
+        Gtk.Dialog.__init__(self, title, parent)
+        self.set_position(Gtk.WindowPosition.CENTER_ALWAYS)
+        self.set_size_request(330, 30)
+        self.set_resizable(False)
+        self.connect('destroy', self.close)
+        self.set_modal(True)
+        vbox = Gtk.VBox(spacing=5)
+        vbox.set_border_width(5)
+        self.get_content_area().add(vbox)
+        #
+        frame1 = Gtk.Frame()
+        vbox.pack_start(frame1, True, True, 0)
+        table = Gtk.Table(3, 2, False)
+        frame1.add(table)
+        #
+        self.label = Gtk.Label()
+        table.attach(self.label, 0, 2, 0, 1,
+                     xpadding=5,
+                     ypadding=5,
+                     xoptions=Gtk.AttachOptions.SHRINK,
+                     yoptions=Gtk.AttachOptions.EXPAND)
+        #
+        self.progressbar = Gtk.ProgressBar()
+        self.progressbar.set_size_request(300, 0)
+        table.attach(self.progressbar, 0, 1, 1, 2,
+                     xpadding=5,
+                     ypadding=5,
+                     xoptions=Gtk.AttachOptions.SHRINK,
+                     yoptions=Gtk.AttachOptions.EXPAND)
+        button_stop = Gtk.Button()
+        button_stop.set_size_request(40, 40)
+        button_stop.set_image(
+            Gtk.Image.new_from_stock(Gtk.STOCK_STOP, Gtk.IconSize.BUTTON))
+        button_stop.connect('clicked', self.on_button_stop_clicked)
+        table.attach(button_stop, 1, 2, 1, 2,
+                     xpadding=5,
+                     ypadding=5,
+                     xoptions=Gtk.AttachOptions.SHRINK)
+        self.stats = Gtk.Label()
+        table.attach(self.stats, 0, 2, 2, 3,
+                     xpadding=5,
+                     ypadding=5,
+                     xoptions=Gtk.AttachOptions.SHRINK,
+                     yoptions=Gtk.AttachOptions.EXPAND)
+        self.stop = False
+        self.show_all()
+        self.max_value = float(max_value)
+        self.value = 0.0
+
+    def emit(self, *args):
+        GLib.idle_add(GObject.GObject.emit, self, *args)
+
+    def set_max_value(self, anobject, max_value):
+        self.max_value = float(max_value)
+
+    def get_stop(self):
+        return self.stop
+
+    def on_button_stop_clicked(self, widget):
+        self.stop = True
+        self.emit('i-want-stop')
+
+    def close(self, *args):
+        self.destroy()
+
+    def set_element(self, anobject, element):
+        self.label.set_text(_('Compress: %s') % element)
+
+    def increase(self, anobject, value):
+        self.value += float(value)
+        if self.max_value > 0:
+            fraction = min(self.value / self.max_value, 1.0)
+        else:
+            fraction = 1.0
+        self.progressbar.set_fraction(fraction)
+
+    def set_progress(self, anobject, progress):
+        self.stats.set_text(format_progress(progress))
+
+
+class DoItInBackground(GObject.GObject, Thread):
+    """Reduces the images in a thread of its own.
+
+    The results are gathered here and the signals are emitted from the
+    main loop every REFRESH_INTERVAL ms, not once per image, so a huge
+    batch doesn't flood the main loop. Then 'start_one' is the last image
+    done, 'end_one' the input bytes done since the previous refresh and
+    'progress' a `Progress.snapshot`.
+
+    With `archive` the images are written into that .zip or .tar file, see
+    archive.py, instead of next to the originals."""
+    __gsignals__ = {
+        'started': (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE,
+                    (GObject.TYPE_INT64,)),
+        'ended': (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (bool,)),
+        'start_one': (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE, (str,)),
+        'end_one': (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE,
+                    (GObject.TYPE_INT64,)),
+        'failed_one': (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE,
+                       (str, str,)),
+        'progress': (GObject.SIGNAL_RUN_FIRST, GObject.TYPE_NONE,
+                     (GObject.TYPE_PYOBJECT,)),
+    }
+
+    def __init__(self, elements, workers=None, archive=None):
+        GObject.GObject.__init__(self)
+        Thread.__init__(self)
+        self.elements = elements
+        self.workers = workers
+        self.archive = archive
+        self.errors = []
+        self.skipped = []
+        self.stopit = False
+        self.ok = True
+        self.daemon = True
+        self.reducer = None
+        self.progress = Progress(len(elements))
+        self.lock = Lock()
+        self.current = None
+        self.pending = 0
+        self.failures = []
+        self.finished = False
+
+    def emit(self, *args):
+        GLib.idle_add(GObject.GObject.emit, self, *args)
+
+    def stop(self, *args):
+        self.stopit = True
+        if self.reducer is not None:
+            self.reducer.stop()
+
+    def refresh(self):
+        with self.lock:
+            current = self.current
+            pending = self.pending
+            failures = self.failures
+            finished = self.finished
+            self.current = None
+            self.pending = 0
+            self.failures = []
+        if current is not None:
+            GObject.GObject.emit(self, 'start_one', current)
+        for element, error in failures:
+            GObject.GObject.emit(self, 'failed_one', element, error)
+        if pending > 0:
+            GObject.GObject.emit(self, 'end_one', pending)
+        GObject.GObject.emit(self, 'progress', self.progress.snapshot())
+        if finished is True:
+            GObject.GObject.emit(self, 'ended', self.ok)
+            return False
+        return True
+
+    def run(self):
+        # it emits 'ended' once finished, whatever happens next
+        GLib.timeout_add(REFRESH_INTERVAL, self.refresh)
+        profile = None
+        try:
+            total = 0
+            for element in self.elements:
+                try:
+                    total += os.path.getsize(element)
+                except OSError:
+                    # gone since it was selected, the reducer reports it
+                    pass
+            self.progress = Progress(len(self.elements), total)
+            self.emit('started', total)
+            options = read_config()
+            if self.archive is not None:
+                options['archive'] = self.archive
+            if get_profile_file(options) is not None:
+                profile = ProfileLog(get_profile_file(options))
+            # a pool can't be forked safely from this thread of Nautilus
+            # without a forkserver, Python 2 has none, then the images are
+            # reduced out of it by the daemon
+            if options['daemon'] is True or \
+                    (is_embedded() and get_pool_context() is None):
+                self.reducer = RemoteReducer(options, self.workers)
+            else:
+                self.reducer = Reducer(options, self.workers)
+            if self.stopit is True:
+                self.reducer.stop()
+            for result in self.reducer.run(self.elements):
+                print(result.source)
+                self.progress.add(result)
+                if profile is not None:
+                    profile.add(result)
+                with self.lock:
+                    self.current = result.source
+                    self.pending += result.size
+                    if result.status == FAILED:
+                        self.ok = False
+                        self.errors.append((result.source, result.error))
+                        self.failures.append((result.source, result.error))
+                    elif result.status == SKIPPED:
+                        self.skipped.append(result.source)
+        except Exception as e:
+            print(e)
+            self.ok = False
+        finally:
+            print(format_summary(self.progress.snapshot()))
+            if profile is not None:
+                profile.close()
+                print(profile.summary())
+            with self.lock:
+                if self.stopit is True:
+                    self.ok = False
+                self.finished = True
+
+
+class ConfigDialog(Gtk.Dialog):
+
+    def __init__(self, title, parent):
+        Gtk.Dialog.__init__(self,
+                            title,
+                            parent,
+                            Gtk.DialogFlags.MODAL |
+                            Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                            (Gtk.STOCK_CANCEL, Gtk.ResponseType.REJECT,
+                             Gtk.STOCK_OK, Gtk.ResponseType.ACCEPT))
+
+        self.set_position(Gtk.WindowPosition.CENTER_ALWAYS)
+        self.set_resizable(False)
+        self.connect('destroy', self.close)
+        self.connect('response', self.on_response)
+        self.set_modal(True)
+
+        frame = Gtk.Frame()
+        frame.set_margin_top(MARGIN)
+        frame.set_margin_bottom(MARGIN)
+        frame.set_margin_right(MARGIN)
+        frame.set_margin_left(MARGIN)
+        self.get_content_area().add(frame)
+
+        grid = Gtk.Grid()
+        grid.set_margin_top(MARGIN)
+        grid.set_margin_bottom(MARGIN)
+        grid.set_margin_right(MARGIN)
+        grid.set_margin_left(MARGIN)
+        grid.set_row_spacing(MARGIN)
+        grid.set_row_homogeneous(False)
+        grid.set_column_spacing(MARGIN)
+        grid.set_column_homogeneous(False)
+        frame.add(grid)
+        #
+        label = Gtk.Label('Width' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 0, 1, 1)
+        self.width = Gtk.Entry()
+        self.width.set_size_request(200, 0)
+        grid.attach(self.width, 1, 0, 1, 1)
+
+        label = Gtk.Label('Height' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 1, 1, 1)
+        self.height = Gtk.Entry()
+        grid.attach(self.height, 1, 1, 1, 1)
+
+        label = Gtk.Label('Border width' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 2, 1, 1)
+        self.border_width = Gtk.Entry()
+        grid.attach(self.border_width, 1, 2, 1, 1)
+
+        label = Gtk.Label('Background color' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 3, 1, 1)
+        self.color = Gtk.ColorButton()
+        # self.color.connect('button-release-event', self.on_color_clicked)
+        grid.attach(self.color, 1, 3, 1, 1)
+
+        label = Gtk.Label('quality' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 4, 1, 1)
+        self.quality = Gtk.HScale.new_with_range(0, 100, 1)
+        grid.attach(self.quality, 1, 4, 1, 1)
+
+        label = Gtk.Label('Convert to jpeg' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 5, 1, 1)
+        box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 5)
+        grid.attach(box, 1, 5, 1, 1)
+        self.tojpeg = Gtk.Switch()
+        box.pack_start(self.tojpeg, False, False, 0)
+
+        label = Gtk.Label('Overwrite' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 6, 1, 1)
+        box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 5)
+        grid.attach(box, 1, 6, 1, 1)
+        self.overwrite = Gtk.Switch()
+        box.pack_start(self.overwrite, False, False, 0)
+
+        label = Gtk.Label('Max KB per image (0 = no limit)' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 7, 1, 1)
+        self.max_kb = Gtk.SpinButton.new_with_range(0, 100000, 10)
+        grid.attach(self.max_kb, 1, 7, 1, 1)
+
+        label = Gtk.Label('Workers (0 = one per core)' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 8, 1, 1)
+        self.workers = Gtk.SpinButton.new_with_range(0, 256, 1)
+        grid.attach(self.workers, 1, 8, 1, 1)
+
+        label = Gtk.Label('Skip already reduced' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 9, 1, 1)
+        box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 5)
+        grid.attach(box, 1, 9, 1, 1)
+        self.cache = Gtk.Switch()
+        box.pack_start(self.cache, False, False, 0)
+
+        label = Gtk.Label('Check content too' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 10, 1, 1)
+        box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 5)
+        grid.attach(box, 1, 10, 1, 1)
+        self.cache_hash = Gtk.Switch()
+        box.pack_start(self.cache_hash, False, False, 0)
+
+        label = Gtk.Label('Memory MB (0 = half of RAM)' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 11, 1, 1)
+        self.memory_mb = Gtk.SpinButton.new_with_range(0, 1048576, 128)
+        grid.attach(self.memory_mb, 1, 11, 1, 1)
+
+        label = Gtk.Label('Max megapixels (0 = no limit)' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 12, 1, 1)
+        self.max_megapixels = Gtk.SpinButton.new_with_range(0, 100000, 10)
+        grid.attach(self.max_megapixels, 1, 12, 1, 1)
+
+        label = Gtk.Label('Keep images that already fit' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 13, 1, 1)
+        box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 5)
+        grid.attach(box, 1, 13, 1, 1)
+        self.probe = Gtk.Switch()
+        self.probe.set_tooltip_text(
+            'JPEG images smaller than the size and at or below the quality'
+            ' are copied as they are, without border')
+        box.pack_start(self.probe, False, False, 0)
+
+        label = Gtk.Label('Output format' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 14, 1, 1)
+        self.format = Gtk.ComboBoxText()
+        self.format.append('', 'As "Convert to jpeg" says')
+        for format in get_output_formats():
+            self.format.append(format, format.upper())
+        grid.attach(self.format, 1, 14, 1, 1)
+
+        label = Gtk.Label('WebP effort (0 = fastest)' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 15, 1, 1)
+        self.webp_method = Gtk.SpinButton.new_with_range(0, 6, 1)
+        grid.attach(self.webp_method, 1, 15, 1, 1)
+
+        label = Gtk.Label('AVIF speed (10 = fastest)' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 16, 1, 1)
+        self.avif_speed = Gtk.SpinButton.new_with_range(0, 10, 1)
+        grid.attach(self.avif_speed, 1, 16, 1, 1)
+
+        label = Gtk.Label('Renditions' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 17, 1, 1)
+        self.renditions = Gtk.Entry()
+        self.renditions.set_tooltip_text(
+            'Comma separated name:WIDTHxHEIGHT[:quality[:format[:border]]],'
+            ' for example web:1200x600, thumb:160x160:70. When set they are'
+            ' written instead of a single image')
+        grid.attach(self.renditions, 1, 17, 1, 1)
+
+        label = Gtk.Label('Share workers between windows' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 18, 1, 1)
+        box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 5)
+        grid.attach(box, 1, 18, 1, 1)
+        self.daemon = Gtk.Switch()
+        self.daemon.set_tooltip_text(
+            'Run the images of every window in one background service, it'
+            ' quits after some minutes without work')
+        box.pack_start(self.daemon, False, False, 0)
+
+        label = Gtk.Label('Use the camera thumbnail' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 19, 1, 1)
+        box = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 5)
+        grid.attach(box, 1, 19, 1, 1)
+        self.preview = Gtk.Switch()
+        self.preview.set_tooltip_text(
+            'Make small images from the thumbnail the camera saved in the'
+            ' photo, when it is big enough, instead of the whole photo')
+        box.pack_start(self.preview, False, False, 0)
+
+        label = Gtk.Label('Resampling' + ':')
+        label.set_alignment(0.0, 0.5)
+        grid.attach(label, 0, 20, 1, 1)
+        self.resampling = Gtk.ComboBoxText()
+        self.resampling.set_tooltip_text(
+            'fast shrinks big photos several times faster, best is the'
+            ' sharpest and the slowest')
+        for tier in RESAMPLING_TIERS:
+            self.resampling.append(tier, tier.capitalize())
+        grid.attach(self.resampling, 1, 20, 1, 1)
+
+        options = read_config()
+        self.width.set_text(str(options['width']))
+        self.height.set_text(str(options['height']))
+        self.border_width.set_text(str(options['border_width']))
+        self.color.set_rgba(hex_to_rgba(options['color']))
+        self.quality.set_value(options['quality'])
+        self.tojpeg.set_active(options['tojpeg'])
+        self.overwrite.set_active(options['overwrite'])
+        self.workers.set_value(options['workers'])
+        self.max_kb.set_value(options['max_kb'])
+        self.cache.set_active(options['cache'])
+        self.cache_hash.set_active(options['cache_hash'])
+        self.memory_mb.set_value(options['memory_mb'])
+        self.max_megapixels.set_value(options['max_megapixels'])
+        self.probe.set_active(options['probe'])
+        if not self.format.set_active_id(options['format']):
+            self.format.set_active_id('')
+        self.webp_method.set_value(options['webp_method'])
+        self.avif_speed.set_value(options['avif_speed'])
+        self.daemon.set_active(options['daemon'])
+        self.preview.set_active(options['preview'])
+        self.resampling.set_active_id(options['resampling'])
+        self.renditions.set_text(', '.join(
+            format_rendition(rendition)
+            for rendition in options['renditions']))
+
+        self.show_all()
+
+    def on_response(self, widget, response):
+        """Keep the dialog open, telling why, while its settings are not
+        valid, so nothing is lost when they are saved."""
+        if response != Gtk.ResponseType.ACCEPT:
+            return
+        try:
+            self.get_options()
+        except ValueError as e:
+            self.stop_emission_by_name('response')
+            show_error(self, _('Invalid settings'), str(e))
+
+    def get_options(self):
+        """Return the options of the dialog, ValueError if some are not
+        valid."""
+        width = get_int(self.width, _('width'))
+        height = get_int(self.height, _('height'))
+        border_width = get_int(self.border_width, _('border width'))
+        color = rgba_to_hex(self.color.get_rgba())
+        quality = int(self.quality.get_value())
+        tojpeg = self.tojpeg.get_active()
+        overwrite = self.overwrite.get_active()
+        workers = int(self.workers.get_value())
+        max_kb = int(self.max_kb.get_value())
+        cache = self.cache.get_active()
+        cache_hash = self.cache_hash.get_active()
+        memory_mb = int(self.memory_mb.get_value())
+        max_megapixels = int(self.max_megapixels.get_value())
+        probe = self.probe.get_active()
+        format = self.format.get_active_id() or ''
+        webp_method = int(self.webp_method.get_value())
+        avif_speed = int(self.avif_speed.get_value())
+        daemon = self.daemon.get_active()
+        preview = self.preview.get_active()
+        resampling = self.resampling.get_active_id() or 'balanced'
+        defaults = {'width': width, 'height': height,
+                    'border_width': border_width, 'quality': quality,
+                    'tojpeg': tojpeg, 'format': format}
+        renditions = [parse_rendition(text, defaults)
+                      for text in self.renditions.get_text().split(',')
+                      if text.strip()]
+        # keep the settings that are not in the dialog
+        options = read_config()
+        options.update(width=width, height=height, border_width=border_width,
+                       color=color, quality=quality, tojpeg=tojpeg,
+                       overwrite=overwrite, max_kb=max_kb, workers=workers,
+                       cache=cache, cache_hash=cache_hash,
+                       memory_mb=memory_mb, max_megapixels=max_megapixels,
+                       probe=probe, format=format, webp_method=webp_method,
+                       avif_speed=avif_speed, daemon=daemon, preview=preview,
+                       resampling=resampling, renditions=renditions)
+        return options
+
+    def save(self):
+        write_config(**self.get_options())
+
+    def close(self, *args):
+        self.destroy()
+
+
+def get_int(entry, name):
+    """Return the number in `entry`, ValueError naming it if it isn't."""
+    try:
+        return int(entry.get_text())
+    except ValueError:
+        raise ValueError('Invalid {0}: {1}'.format(name, entry.get_text()))
+
+
+def show_error(window, message, details):
+    dialog = Gtk.MessageDialog(parent=window,
+                               flags=Gtk.DialogFlags.MODAL,
+                               type=Gtk.MessageType.ERROR,
+                               buttons=Gtk.ButtonsType.CLOSE,
+                               message_format=message)
+    dialog.format_secondary_text(details)
+    dialog.run()
+    dialog.destroy()
+
+
+def show_errors(window, errors):
+    dialog = Gtk.MessageDialog(parent=window,
+                               flags=Gtk.DialogFlags.MODAL,
+                               type=Gtk.MessageType.WARNING,
+                               buttons=Gtk.ButtonsType.CLOSE,
+                               message_format=_('Some images could not '
+                                                'be reduced'))
+    dialog.format_secondary_text('\n'.join(
+        '{0}: {1}'.format(element, error) for element, error in errors))
+    dialog.run()
+    dialog.destroy()
+
+
+def ask_archive(window, elements):
+    """Return the archive the user chooses to write `elements` into, None
+    if cancelled."""
+    dialog = Gtk.FileChooserDialog(_('Reduce images into an archive'),
+                                   window, Gtk.FileChooserAction.SAVE,
+                                   (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                    Gtk.STOCK_SAVE, Gtk.ResponseType.ACCEPT))
+    dialog.set_do_overwrite_confirmation(True)
+    dialog.set_current_folder(os.path.dirname(os.path.abspath(elements[0])))
+    dialog.set_current_name(_('reduced') + '.zip')
+    for extension in ARCHIVE_EXTENSIONS:
+        afilter = Gtk.FileFilter()
+        afilter.set_name(extension[1:].upper())
+        afilter.add_pattern('*' + extension)
+        dialog.add_filter(afilter)
+    archive = None
+    while dialog.run() == Gtk.ResponseType.ACCEPT:
+        archive = dialog.get_filename()
+        if is_archive(archive):
+            # the dialog asked already if it exists
+            break
+        # the dialog only asked about the name without the extension
+        archive += ARCHIVE_EXTENSIONS[0]
+        if not os.path.exists(archive) or confirm_overwrite(dialog, archive):
+            break
+        dialog.set_current_name(os.path.basename(archive))
+        archive = None
+    dialog.destroy()
+    return archive
+
+
+def confirm_overwrite(window, afile):
+    """Return if the user agrees to replace `afile`."""
+    dialog = Gtk.MessageDialog(parent=window,
+                               flags=Gtk.DialogFlags.MODAL,
+                               type=Gtk.MessageType.QUESTION,
+                               buttons=Gtk.ButtonsType.YES_NO,
+                               message_format=_('Replace {0}?').format(
+                                   os.path.basename(afile)))
+    dialog.format_secondary_text(_('A file with that name already exists.'))
+    answer = dialog.run()
+    dialog.destroy()
+    return answer == Gtk.ResponseType.YES
+
+
+def show_about(window):
+    ad = Gtk.AboutDialog(parent=window)
+    ad.set_name(APP)
+    ad.set_version(VERSION)
+    ad.set_copyright('Copyrignt (c) 2017\nLorenzo Carbonell')
+    ad.set_comments(APP)
+    ad.set_license('''
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <http://www.gnu.org/licenses/>.
+''')
+    ad.set_website('http://www.atareao.es')
+    ad.set_website_label('http://www.atareao.es')
+    ad.set_authors([
+        'Lorenzo Carbonell <lorenzo.carbonell.cerezo@gmail.com>'])
+    ad.set_documenters([
+        'Lorenzo Carbonell <lorenzo.carbonell.cerezo@gmail.com>'])
+    ad.set_icon_name(APP)
+    ad.set_logo_icon_name(APP)
+    ad.run()
+    ad.destroy()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import sys
+import fcntl
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+from .profiling import stage
+
+# the ioctl that makes a file share the blocks of another, Linux only
+FICLONE = 0x40049409
+
+_umask = None
+# what `write_atomic` was asked to write in this process since `collect`,
+# by file, None when it writes to the files
+_collected = None
+
+
+def get_umask():
+    global _umask
+    if _umask is None:
+        _umask = os.umask(0)
+        os.umask(_umask)
+    return _umask
+
+
+def fsync_directory(directory):
+    """Flush the entries of `directory`, so a rename in it survives a
+    crash."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError as e:
+        sys.stderr.write('{0}\n'.format(e))
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # not every filesystem can sync a directory
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def locked(filename, exclusive=True):
+    """Hold the lock of `filename` meanwhile, exclusive or shared with
+    the other holders of a shared one, in this process or any other. The
+    lock is the file `filename` + '.lock'."""
+    fd = os.open(filename + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        # closing it releases the lock
+        os.close(fd)
+
+
+def collect():
+    """Keep what `write_atomic` writes in this process in memory from now
+    on, instead of writing it to the files."""
+    global _collected
+    _collected = OrderedDict()
+
+
+def get_collected():
+    """Return the (filename, data) kept since `collect`, in the order they
+    were written, and write to the files again."""
+    global _collected
+    collected, _collected = _collected, None
+    return list(collected.items())
+
+
+def get_size(filename):
+    """Return the size of `filename`, or of what was kept for it."""
+    if _collected is not None and filename in _collected:
+        return len(_collected[filename])
+    return os.path.getsize(filename)
+
+
+def create_temporary(filename):
+    """Return the (fd, name) of a new temporary file to write `filename`
+    to, in the same directory so it can be renamed over it."""
+    directory = os.path.dirname(os.path.abspath(filename))
+    return tempfile.mkstemp(dir=directory, prefix='.reduceimages-',
+                            suffix='.tmp')
+
+
+def commit(tmpfile, filename):
+    """Rename the temporary file `tmpfile`, already fsync'd, over
+    `filename`, keeping its mode."""
+    if os.path.exists(filename):
+        mode = os.stat(filename).st_mode & 0o7777
+    else:
+        mode = 0o666 & ~get_umask()
+    os.chmod(tmpfile, mode)
+    os.rename(tmpfile, filename)
+
+
+def remove_temporary(tmpfile):
+    try:
+        os.remove(tmpfile)
+    except OSError:
+        pass
+
+
+def write_atomic(filename, write):
+    """Write `filename` with `write(fileobj)`.
+
+    The content goes to a temporary file in the same directory, it is
+    fsync'd and then renamed over `filename`. A crash, a kill or a full
+    disk in the middle leaves `filename` as it was, never half written.
+
+    After `collect` the content is only kept in memory."""
+    if _collected is not None:
+        buffer = BytesIO()
+        with stage('encode'):
+            write(buffer)
+        _collected[filename] = buffer.getvalue()
+        return
+    fd, tmpfile = create_temporary(filename)
+    try:
+        with os.fdopen(fd, 'wb') as fw:
+            with stage('encode'):
+                write(fw)
+            with stage('sync'):
+                fw.flush()
+                os.fsync(fw.fileno())
+        with stage('sync'):
+            commit(tmpfile, filename)
+    except BaseException:
+        remove_temporary(tmpfile)
+        raise
+    with stage('sync'):
+        fsync_directory(os.path.dirname(os.path.abspath(filename)))
+
+
+def reflink_file(source, filename):
+    """Write `filename` sharing the blocks of `source`, on filesystems
+    that can (btrfs, xfs...). Returns False if it can't."""
+    def write(fw):
+        with open(source, 'rb') as fr:
+            fcntl.ioctl(fw.fileno(), FICLONE, fr.fileno())
+    try:
+        write_atomic(filename, write)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def link_file(source, filename):
+    """Make `filename` a hard link of `source`. Returns False if it
+    can't, across filesystems for instance."""
+    fd, tmpfile = create_temporary(filename)
+    os.close(fd)
+    os.remove(tmpfile)
+    try:
+        os.link(source, tmpfile)
+    except OSError:
+        return False
+    try:
+        os.rename(tmpfile, filename)
+    except BaseException:
+        remove_temporary(tmpfile)
+        raise
+    fsync_directory(os.path.dirname(os.path.abspath(filename)))
+    return True
+
+
+def clone_file(source, filename, hardlink=True):
+    """Make `filename` have the content of `source` as cheaply as the
+    filesystem allows: a reflink, else a hard link if `hardlink`, else a
+    copy. A hard link shares later in place edits of either file."""
+    if reflink_file(source, filename) or \
+            (hardlink is True and link_file(source, filename)):
+        return
+    with open(source, 'rb') as fr:
+        write_atomic(filename, lambda fw: shutil.copyfileobj(fr, fw))
@@ -0,0 +1,578 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import shutil
+import struct
+from collections import namedtuple
+from io import BytesIO
+from math import log
+from threading import Lock
+from PIL import Image
+from .files import write_atomic
+from .profiling import stage
+try:
+    # registers the AVIF encoder on Pillow versions without it
+    import pillow_avif  # noqa
+except ImportError:
+    pass
+
+# JPEG sources are decoded at a DCT scale (1/2, 1/4, 1/8) that keeps them
+# at least DRAFT_GAP times larger than the target so the final resampling
+# still has enough pixels to work with
+DRAFT_GAP = 2
+# by resampling tier, the gap JPEG files are decoded at (None decodes them
+# whole), the gap Image.reduce shrinks the image to by an integer factor
+# before the final filter (None never does) and that filter. 'balanced'
+# is what thumbnail does by default
+RESAMPLINGS = {
+    'fast': (1, 1.0, Image.BILINEAR),
+    'balanced': (DRAFT_GAP, 2.0, Image.LANCZOS),
+    'best': (None, None, Image.LANCZOS),
+}
+# the arguments of `reduce_image` after the file, as named in the config
+REDUCE_KEYS = ('width', 'height', 'border_width', 'color', 'quality',
+               'tojpeg', 'overwrite', 'max_kb', 'renditions', 'format',
+               'webp_method', 'avif_speed', 'preview', 'resampling')
+# extension of the files written in every output format, 'original'
+# keeps the extension of the source
+FORMAT_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp',
+                     'avif': '.avif'}
+# formats whose size depends on the quality, max_kb only applies to them
+LOSSY_FORMATS = ('JPEG', 'WEBP', 'AVIF')
+# the size budget search never goes under this quality, and stops once it
+# is this close to the best quality. QUALITY_STEP is its first move away
+# from the guess
+MIN_QUALITY = 10
+QUALITY_TOLERANCE = 2
+QUALITY_STEP = 3
+# what to do with a file after probing its header, see `get_action`
+KEEP = 'keep'
+COPY = 'copy'
+REDUCE = 'reduce'
+# luminance quantization table of the JPEG standard, the one the IJG
+# encoder scales by the quality
+STD_LUMINANCE = (
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99)
+# last quality that met the budget, by format, size and budget. It is the
+# first guess for the next image, images in a batch tend to be alike
+_qualities = {}
+# held while Pillow's decompression bomb check is off to probe a header
+_probe_lock = Lock()
+
+# transpose that shows an image the way its EXIF orientation says, the
+# last four swap its width and height
+ORIENTATIONS = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+SWAPPED = (5, 6, 7, 8)
+# EXIF tags of the orientation, in IFD0, and of the thumbnail, in IFD1
+ORIENTATION = 0x0112
+THUMBNAIL_OFFSET = 0x0201
+THUMBNAIL_LENGTH = 0x0202
+# how much the shape of a preview may differ from its image's, many are
+# 4:3 with black bars whatever the shape of the picture
+PREVIEW_ASPECT_TOLERANCE = 0.02
+
+# what the header of an image tells, quality is only estimated for JPEG
+# and size is the one it is shown at, turned by its EXIF orientation
+Probe = namedtuple('Probe', ['format', 'size', 'bands', 'quality'])
+
+
+def read_ifd(tiff, order, offset):
+    """Return the tags of the IFD at `offset` of `tiff` as a dict, and
+    the offset of the next IFD."""
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    tags = {}
+    for index in range(count):
+        entry = tiff[offset + 2 + 12 * index:offset + 14 + 12 * index]
+        tag, kind = struct.unpack(order + 'HH', entry[:4])
+        if kind == 3:
+            # a SHORT is in the first half of the value
+            tags[tag] = struct.unpack(order + 'H', entry[8:10])[0]
+        else:
+            tags[tag] = struct.unpack(order + 'I', entry[8:12])[0]
+    next_offset = offset + 2 + 12 * count
+    return tags, struct.unpack(order + 'I',
+                               tiff[next_offset:next_offset + 4])[0]
+
+
+def read_exif(exif):
+    """Return the (orientation, thumbnail) in the `exif` block of a JPEG,
+    the thumbnail is its JPEG data or None."""
+    if not exif or not exif.startswith(b'Exif\x00\x00'):
+        return 1, None
+    tiff = exif[6:]
+    order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if order is None:
+        return 1, None
+    try:
+        ifd0, offset = read_ifd(tiff, order,
+                                struct.unpack(order + 'I', tiff[4:8])[0])
+        orientation = ifd0.get(ORIENTATION, 1)
+        if offset == 0:
+            return orientation, None
+        ifd1 = read_ifd(tiff, order, offset)[0]
+    except struct.error:
+        return 1, None
+    start = ifd1.get(THUMBNAIL_OFFSET, 0)
+    length = ifd1.get(THUMBNAIL_LENGTH, 0)
+    if start == 0 or length == 0 or start + length > len(tiff):
+        return orientation, None
+    return orientation, tiff[start:start + length]
+
+
+def open_preview(thumbnail, size, box):
+    """Return the EXIF `thumbnail` of an image of `size` if it has the
+    same shape and is big enough to be reduced to fit in `box`, else
+    None."""
+    try:
+        im = Image.open(BytesIO(thumbnail))
+        im.load()
+    except Exception:
+        return None
+    if abs(float(im.size[0]) / im.size[1] - float(size[0]) / size[1]) > \
+            PREVIEW_ASPECT_TOLERANCE:
+        return None
+    ratio = min(float(box[0]) / size[0], float(box[1]) / size[1], 1.0)
+    if im.size[0] < int(size[0] * ratio) or im.size[1] < int(size[1] * ratio):
+        return None
+    return im
+
+
+def open_image(originalFile, size, preview=False, draft_gap=DRAFT_GAP):
+    """Open `originalFile` to be reduced to fit in `size`, turned the way
+    its EXIF orientation says.
+
+    JPEG files are decoded at the smallest DCT scale that is still
+    `draft_gap` times larger than `size`, or whole if it is None, any
+    other format is fully decoded. With `preview`, the EXIF thumbnail of
+    a JPEG is used instead when it is big enough, so the image is not
+    decoded at all."""
+    with stage('open'):
+        im = Image.open(originalFile)
+        if im.format != 'JPEG':
+            return im
+        orientation, thumbnail = read_exif(im.info.get('exif'))
+        if orientation in SWAPPED:
+            size = (size[1], size[0])
+        if preview is True and thumbnail is not None:
+            thumbnail = open_preview(thumbnail, im.size, size)
+        else:
+            thumbnail = None
+        if thumbnail is not None:
+            im = thumbnail
+        elif draft_gap is not None:
+            im.draft(im.mode, (size[0] * draft_gap, size[1] * draft_gap))
+    if orientation in ORIENTATIONS:
+        with stage('decode'):
+            im = im.transpose(ORIENTATIONS[orientation])
+    return im
+
+
+def get_draft_scale(size, box, draft_gap=DRAFT_GAP):
+    """Return the DCT scale `open_image` decodes a JPEG of `size` at to
+    fit in `box`, the same that Image.draft picks."""
+    if draft_gap is None:
+        return 1
+    scale = min(size[0] // max(box[0] * draft_gap, 1),
+                size[1] // max(box[1] * draft_gap, 1))
+    for candidate in (8, 4, 2, 1):
+        if scale >= candidate:
+            return candidate
+    return 1
+
+
+def estimate_quality(quantization):
+    """Return the IJG quality the JPEG `quantization` tables were made
+    with, None if there are none.
+
+    The luminance table is compared with the standard one, so the result
+    is only approximate for other encoders."""
+    if not quantization:
+        return None
+    table = quantization[min(quantization)]
+    scale = 100.0 * sum(table) / sum(STD_LUMINANCE)
+    if scale <= 100.0:
+        quality = (200.0 - scale) / 2.0
+    else:
+        quality = 5000.0 / scale
+    return max(1, min(int(round(quality)), 100))
+
+
+def probe_image(originalFile):
+    """Return the `Probe` of `originalFile`, only the header is read.
+
+    Pillow's decompression bomb check is off meanwhile: the header of a
+    bomb is harmless and its size is needed to reject it, see
+    `max_megapixels`."""
+    with _probe_lock:
+        max_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            im = Image.open(originalFile)
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_pixels
+    try:
+        size = im.size
+        quality = None
+        if im.format == 'JPEG':
+            quality = estimate_quality(getattr(im, 'quantization', None))
+            if read_exif(im.info.get('exif'))[0] in SWAPPED:
+                size = (size[1], size[0])
+        return Probe(im.format, size, len(im.getbands()), quality)
+    finally:
+        im.close()
+
+
+def estimate_memory(probe, width, height, border_width,
+                    resampling='balanced'):
+    """Return the (pixels, bytes) `reduce_image` needs for the image of
+    `probe`.
+
+    The bytes are the decoded image, at its DCT scale for JPEG, plus the
+    image resized from it, the RGBA canvas and its RGB copy."""
+    size = probe.size
+    scale = 1
+    if probe.format == 'JPEG':
+        scale = get_draft_scale(size, (width - 2 * border_width,
+                                       height - 2 * border_width),
+                                RESAMPLINGS[resampling][0])
+    decoded = ((size[0] + scale - 1) // scale) * \
+        ((size[1] + scale - 1) // scale)
+    return size[0] * size[1], decoded * probe.bands + \
+        width * height * (probe.bands + 4 + 3)
+
+
+def get_action(originalFile, probe, options):
+    """Return what to do with `originalFile` after probing it.
+
+    A JPEG that already fits in the box, at or below the quality and
+    under the size budget is not padded nor encoded again: it is kept
+    where it is if it would be written over itself, else it is copied to
+    its destination. Anything else, and everything with renditions or
+    with `probe` off, is reduced."""
+    if options.get('probe') is not True or options.get('renditions') or \
+            probe.format != 'JPEG' or probe.quality is None or \
+            probe.quality > options['quality']:
+        return REDUCE
+    border_width = options['border_width']
+    if probe.size[0] > options['width'] - 2 * border_width or \
+            probe.size[1] > options['height'] - 2 * border_width:
+        return REDUCE
+    if options['max_kb'] > 0 and \
+            os.path.getsize(originalFile) > options['max_kb'] * 1024:
+        return REDUCE
+    destFile = get_dest(originalFile, options['tojpeg'], options['overwrite'],
+                        options['format'])
+    if os.path.splitext(destFile)[1].lower() not in ('.jpg', '.jpeg'):
+        return REDUCE
+    if destFile == originalFile:
+        return KEEP
+    return COPY
+
+
+def copy_image(originalFile, destFile):
+    """Copy `originalFile` to `destFile` as it is."""
+    with stage('copy'):
+        with open(originalFile, 'rb') as fr:
+            write_atomic(destFile, lambda fw: shutil.copyfileobj(fr, fw))
+
+
+def get_job(originalFile, options):
+    """Return the `reduce_image` arguments for `originalFile`."""
+    return (originalFile,) + tuple(options[key] for key in REDUCE_KEYS)
+
+
+def get_output_formats():
+    """Return the output formats this Pillow has an encoder for."""
+    Image.init()
+    return [format for format in sorted(FORMAT_EXTENSIONS)
+            if format.upper() in Image.SAVE]
+
+
+def get_format(afile):
+    """Return the PIL format for the extension of `afile`, ValueError if
+    there is no encoder for it."""
+    Image.init()
+    extension = os.path.splitext(afile)[1].lower()
+    format = Image.EXTENSION.get(extension)
+    if format is None or format not in Image.SAVE:
+        raise ValueError('No encoder for {0} files'.format(extension))
+    return format
+
+
+def get_save_params(format, webp_method=4, avif_speed=6):
+    """Return the encoder arguments of `format` other than the quality.
+
+    `webp_method` goes from 0, fastest, to 6, smallest. `avif_speed` goes
+    the other way round, from 0, smallest, to 10, fastest."""
+    if format == 'WEBP':
+        return {'method': webp_method}
+    if format == 'AVIF':
+        return {'speed': avif_speed}
+    return {'optimize': True}
+
+
+def encode(image, format, quality, params=None):
+    """Return `image` encoded in memory."""
+    buffer = BytesIO()
+    image.save(buffer, format, quality=quality,
+               **(params or get_save_params(format)))
+    return buffer.getvalue()
+
+
+def encode_to_size(image, format, max_quality, max_bytes, params=None):
+    """Return `image` encoded with the highest quality, up to
+    `max_quality`, that fits in `max_bytes`. If none does, with
+    MIN_QUALITY, or `max_quality` if it is lower.
+
+    Every trial is encoded in memory. The search starts from the quality
+    used for the previous image alike, moves away from it in growing
+    steps until the budget is bracketed and then interpolates between both
+    ends, so with a good guess it takes two or three encodes."""
+    key = (format, image.size, max_bytes)
+    low, high = min(MIN_QUALITY, max_quality), max_quality
+    quality = max(low, min(_qualities.get(key, max_quality), high))
+    step = QUALITY_STEP
+    fit = over = None
+    while low <= high:
+        data = encode(image, format, quality, params)
+        if len(data) <= max_bytes:
+            fit = quality, len(data), data
+            low = quality + 1
+        else:
+            over = quality, len(data)
+            high = quality - 1
+        if fit is not None and high - fit[0] <= QUALITY_TOLERANCE:
+            break
+        if fit is not None and over is not None:
+            # the log of the size is about linear with the quality, but
+            # keep a quarter of the bracket off both ends so it shrinks
+            # fast even when it isn't
+            quality = fit[0] + int(
+                (log(max_bytes) - log(fit[1])) * (over[0] - fit[0]) /
+                (log(over[1]) - log(fit[1])))
+            margin = (high - low) // 4
+            quality = max(low + margin, min(quality, high - margin))
+        elif fit is not None:
+            quality = fit[0] + step
+        else:
+            quality = over[0] - step
+        step *= 2
+        quality = max(low, min(quality, high))
+    if fit is None:
+        return encode(image, format, min(MIN_QUALITY, max_quality), params)
+    _qualities[key] = fit[0]
+    return fit[2]
+
+
+def get_dest(originalFile, tojpeg=True, overwrite=True, format=''):
+    """Return the file `originalFile` is reduced to. `format`, if set,
+    overrides `tojpeg`."""
+    filename, fileextension = os.path.splitext(originalFile)
+    if format in FORMAT_EXTENSIONS:
+        fileextension = FORMAT_EXTENSIONS[format]
+    elif tojpeg is True and format != 'original':
+        fileextension = '.jpg'
+    if overwrite is False:
+        return '{0}_reduced{1}'.format(filename, fileextension)
+    return filename + fileextension
+
+
+def sort_renditions(renditions):
+    """Return `renditions` from the biggest to the smallest, the order
+    they are made in."""
+    return sorted(renditions, reverse=True,
+                  key=lambda rendition: rendition['width'] *
+                  rendition['height'])
+
+
+def get_dests(originalFile, options):
+    """Return the files `reduce_image` writes for `originalFile` with
+    `options`, in the order it returns them."""
+    if options['renditions']:
+        return [get_rendition_dest(originalFile, rendition)
+                for rendition in sort_renditions(options['renditions'])]
+    return [get_dest(originalFile, options['tojpeg'], options['overwrite'],
+                     options['format'])]
+
+
+def get_rendition_dest(originalFile, rendition):
+    filename, fileextension = os.path.splitext(originalFile)
+    extension = FORMAT_EXTENSIONS.get(rendition['format'], fileextension)
+    return '{0}_{1}{2}'.format(filename, rendition['name'], extension)
+
+
+def make_background(im, width, height, border_width, color):
+    """Return `im`, that already fits in the box, centred on a `width` x
+    `height` canvas of `color`."""
+    new_width, new_height = im.size
+    x = int((float(width) - float(new_width)) / 2.0)
+    y = int((float(height) - float(new_height)) / 2.0)
+    background = Image.new('RGBA', (width, height), color)
+    background.paste(im, (x, y))
+    return background
+
+
+def save_image(background, destFile, quality, max_kb=0, webp_method=4,
+               avif_speed=6):
+    format = get_format(destFile)
+    params = get_save_params(format, webp_method, avif_speed)
+    if format == 'JPEG':
+        # JPEG has no alpha channel
+        with stage('canvas'):
+            background = background.convert('RGB')
+    if max_kb > 0 and format in LOSSY_FORMATS:
+        with stage('encode'):
+            data = encode_to_size(background, format, quality,
+                                  max_kb * 1024, params)
+        write_atomic(destFile, lambda fw: fw.write(data))
+        return
+    write_atomic(destFile, lambda fw: background.save(fw, format,
+                                                      quality=quality,
+                                                      **params))
+
+
+def resize(im, box, resampling='balanced'):
+    """Shrink `im`, in place, to fit in `box` as the `resampling` tier
+    says, see RESAMPLINGS."""
+    reducing_gap, resample = RESAMPLINGS[resampling][1:]
+    try:
+        im.thumbnail(box, resample, reducing_gap=reducing_gap)
+    except TypeError:
+        # Pillow older than 7.0 has no reducing_gap
+        im.thumbnail(box, resample)
+
+
+def get_fit_size(size, box):
+    """Return the size Image.thumbnail shrinks an image of `size` to, to
+    fit in `box`, None if it already fits."""
+    width, height = size
+    x, y = box
+    if x >= width and y >= height:
+        return None
+    aspect = float(width) / height
+    if float(x) / y >= aspect:
+        x = min(int(y * aspect), int(y * aspect) + 1,
+                key=lambda n: abs(aspect - float(n) / y))
+    else:
+        y = min(int(x / aspect), int(x / aspect) + 1,
+                key=lambda n: 0 if n == 0 else abs(aspect - float(x) / n))
+    return max(x, 1), max(y, 1)
+
+
+def resized(im, box, resampling='balanced'):
+    """Return `im` shrunk to fit in `box` like `resize` does, as a new
+    image, `im` itself if it fits. Unlike a copy shrunk in place, the
+    full size image is never duplicated."""
+    size = get_fit_size(im.size, box)
+    if size is None:
+        return im
+    reducing_gap, resample = RESAMPLINGS[resampling][1:]
+    try:
+        return im.resize(size, resample, reducing_gap=reducing_gap)
+    except TypeError:
+        # Pillow older than 7.0 has no reducing_gap
+        return im.resize(size, resample)
+
+
+def fit_image(originalFile, box, resampling='balanced', preview=False):
+    """Return `originalFile` reduced to fit in `box`."""
+    im = open_image(originalFile, box, preview, RESAMPLINGS[resampling][0])
+    with stage('decode'):
+        im.load()
+    with stage('resample'):
+        resize(im, box, resampling)
+    return im
+
+
+def reduce_renditions(originalFile, renditions, color='#000000', max_kb=0,
+                      webp_method=4, avif_speed=6, preview=False,
+                      resampling='balanced'):
+    """Write every rendition of `originalFile` and return their files.
+
+    The image is decoded once, for the biggest rendition. Every other
+    rendition is resampled from the smallest image already made that is
+    still big enough for it, not from the original."""
+    renditions = sort_renditions(renditions)
+    boxes = [(rendition['width'] - 2 * rendition['border_width'],
+              rendition['height'] - 2 * rendition['border_width'])
+             for rendition in renditions]
+    im = open_image(originalFile, (max(box[0] for box in boxes),
+                                   max(box[1] for box in boxes)), preview,
+                    RESAMPLINGS[resampling][0])
+    with stage('decode'):
+        im.load()
+    width, height = im.size
+    pyramid = [im]
+    destFiles = []
+    for rendition, box in zip(renditions, boxes):
+        ratio = min(float(box[0]) / width, float(box[1]) / height, 1.0)
+        source = min((image for image in pyramid
+                      if image.size[0] >= int(width * ratio) and
+                      image.size[1] >= int(height * ratio)),
+                     key=lambda image: image.size[0])
+        with stage('resample'):
+            rendered = resized(source, box, resampling)
+        pyramid.append(rendered)
+        destFile = get_rendition_dest(originalFile, rendition)
+        with stage('canvas'):
+            background = make_background(rendered, rendition['width'],
+                                         rendition['height'],
+                                         rendition['border_width'], color)
+        save_image(background, destFile, rendition['quality'], max_kb,
+                   webp_method, avif_speed)
+        destFiles.append(destFile)
+    return destFiles
+
+
+def reduce_image(originalFile, width=1200, height=600, border_width=0,
+                 color='#000000', quality=80, tojpeg=True, overwrite=True,
+                 max_kb=0, renditions=(), format='', webp_method=4,
+                 avif_speed=6, preview=False, resampling='balanced'):
+    """Reduce `originalFile` and return the file written.
+
+    With `renditions` the other sizes are ignored, every rendition is
+    written and the list of their files is returned instead."""
+    if renditions:
+        return reduce_renditions(originalFile, renditions, color, max_kb,
+                                 webp_method, avif_speed, preview,
+                                 resampling)
+    destFile = get_dest(originalFile, tojpeg, overwrite, format)
+    new_width = width - 2 * border_width
+    new_height = height - 2 * border_width
+    im = fit_image(originalFile, (new_width, new_height), resampling, preview)
+    with stage('canvas'):
+        background = make_background(im, width, height, border_width, color)
+    save_image(background, destFile, quality, max_kb, webp_method,
+               avif_speed)
+    return destFile
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import sys
+import hashlib
+import json
+from collections import OrderedDict
+from threading import RLock
+from .config import CONFIG_DIR
+from .config import makedirs
+from .files import locked
+from .files import write_atomic
+from .image import REDUCE_KEYS
+
+MANIFEST_FILE = os.path.join(CONFIG_DIR, 'manifest.json')
+MANIFEST_SIZE = 50000
+# settings that change the reduced image
+FINGERPRINT_KEYS = REDUCE_KEYS + ('probe',)
+
+
+def get_fingerprint(options):
+    """Return a digest of the settings that change the reduced image."""
+    values = [options[key] for key in FINGERPRINT_KEYS]
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+def get_digest(afile):
+    """Return the sha1 digest of the content of `afile`."""
+    sha1 = hashlib.sha1()
+    with open(afile, 'rb') as fr:
+        for chunk in iter(lambda: fr.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class Manifest(object):
+    """Files already reduced, and files written by us, with the settings
+    used for them.
+
+    Every entry maps a path to [size, mtime, digest, fingerprint, dests],
+    dests being the [path, size, mtime] of the files it was reduced to. A
+    file is only reduced if they are all still there as they were
+    written. The oldest entries are evicted once there are more than
+    `max_size`.
+
+    Every `add` is also appended to a journal next to the manifest, so the
+    jobs done by a batch that crashed or was killed before `save` are
+    known to the next one, which resumes where it stopped. `save` folds
+    the journal into the manifest.
+
+    A manifest may be shared by threads, and by processes: the daemon,
+    the command line and every Nautilus window. Loading it and appending
+    to the journal hold a shared lock, `save` an exclusive one, and it
+    merges what is on disk, with the journal of every process, before
+    writing it."""
+
+    def __init__(self, filename=MANIFEST_FILE, max_size=MANIFEST_SIZE,
+                 use_digest=False):
+        self.filename = filename
+        self.journal_file = filename + '.journal'
+        self.max_size = max_size
+        self.use_digest = use_digest
+        # entries added by this process since `save`
+        self.added = OrderedDict()
+        self.lock = RLock()
+        makedirs(os.path.dirname(filename))
+        with locked(filename, exclusive=False):
+            self.entries = self.load()
+
+    def load(self):
+        """Return the entries on disk, with the journal applied."""
+        entries = OrderedDict()
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as fr:
+                    entries = json.load(fr, object_pairs_hook=OrderedDict)
+            except (IOError, ValueError) as e:
+                sys.stderr.write('{0}\n'.format(e))
+        self.replay(entries)
+        return entries
+
+    def replay(self, entries):
+        """Apply the journal left by the batches that didn't save, or
+        that are still running, to `entries`."""
+        if not os.path.exists(self.journal_file):
+            return
+        with open(self.journal_file, 'r') as fr:
+            for line in fr:
+                try:
+                    afile, entry = json.loads(line)
+                except ValueError:
+                    # the last line of a killed batch may be incomplete
+                    continue
+                self.set_entry(afile, entry, entries)
+
+    def set_entry(self, afile, entry, entries=None):
+        if entries is None:
+            entries = self.entries
+        entries.pop(afile, None)
+        entries[afile] = entry
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def is_reduced(self, afile, fingerprint):
+        afile = os.path.abspath(afile)
+        with self.lock:
+            entry = self.entries.get(afile)
+        if entry is None or entry[3] != fingerprint:
+            return False
+        try:
+            stat = os.stat(afile)
+        except OSError:
+            return False
+        if entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+            return False
+        if self.use_digest and entry[2] != get_digest(afile):
+            return False
+        # entries written before the dests were kept have four fields
+        dests = entry[4] if len(entry) > 4 else []
+        for dest, size, mtime in dests:
+            try:
+                stat = os.stat(dest)
+            except OSError:
+                return False
+            if stat.st_size != size or stat.st_mtime != mtime:
+                return False
+        return True
+
+    def add(self, afile, fingerprint, dests=()):
+        """Remember `afile` was reduced with `fingerprint` to `dests`."""
+        afile = os.path.abspath(afile)
+        stat = os.stat(afile)
+        digest = get_digest(afile) if self.use_digest else None
+        entry = [stat.st_size, stat.st_mtime, digest, fingerprint, []]
+        for dest in dests:
+            dest = os.path.abspath(dest)
+            if dest != afile:
+                dest_stat = os.stat(dest)
+                entry[4].append([dest, dest_stat.st_size,
+                                 dest_stat.st_mtime])
+        with self.lock:
+            self.set_entry(afile, entry)
+            self.added[afile] = entry
+            with locked(self.filename, exclusive=False):
+                with open(self.journal_file, 'a') as fw:
+                    fw.write(json.dumps([afile, entry]) + '\n')
+
+    def save(self):
+        with self.lock:
+            with locked(self.filename):
+                if not self.added and not os.path.exists(self.journal_file):
+                    return
+                entries = self.load()
+                # the journal has them, unless it couldn't be written
+                for afile, entry in self.added.items():
+                    if afile not in entries:
+                        self.set_entry(afile, entry, entries)
+                data = json.dumps(entries).encode('utf-8')
+                write_atomic(self.filename, lambda fw: fw.write(data))
+                if os.path.exists(self.journal_file):
+                    os.remove(self.journal_file)
+                self.entries = entries
+                self.added.clear()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+"""Opt-in timing of the stages of every reduced image.
+
+It is on with the 'profile' setting or the REDUCEIMAGES_PROFILE
+environment variable, that may name the file to write instead of
+PROFILE_FILE. The worker that reduces an image times every `stage` of it
+and measures the peak of its memory, and the `Result` carries them. The
+process consuming the results writes them as JSON lines with
+`ProfileLog`, and sums them up.
+
+When it is off, `stage` returns a context manager that does nothing."""
+import os
+import re
+import json
+import time
+import resource
+from collections import OrderedDict
+from .config import CONFIG_DIR
+from .config import makedirs
+
+PROFILE_ENV = 'REDUCEIMAGES_PROFILE'
+# the values of PROFILE_ENV that turn it off, or on with the default file,
+# any other one is the file to write to
+PROFILE_OFF = ('', '0', 'false', 'no', 'off')
+PROFILE_ON = ('1', 'true', 'yes', 'on')
+PROFILE_FILE = os.path.join(CONFIG_DIR, 'profile.jsonl')
+# every stage, in the order they happen
+STAGES = ('open', 'decode', 'resample', 'canvas', 'encode', 'sync', 'copy')
+MB = 1048576.0
+
+# stages of the image being reduced in this process, None when off
+_stages = None
+
+
+class NullStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+class Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *args):
+        if _stages is not None:
+            _stages[self.name] = _stages.get(self.name, 0.0) + \
+                time.time() - self.start
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(name):
+    """Return the context manager that times the stage `name`."""
+    if _stages is None:
+        return NULL_STAGE
+    return Stage(name)
+
+
+def get_profile_env():
+    """Return the value of PROFILE_ENV, None if it is unset or says off."""
+    value = os.environ.get(PROFILE_ENV, '').strip()
+    if value.lower() in PROFILE_OFF:
+        return None
+    return value
+
+
+def is_profiling(options):
+    return options.get('profile') is True or get_profile_env() is not None
+
+
+def get_profile_file(options):
+    """Return the file to write the profile to, None if off."""
+    value = get_profile_env()
+    if value is not None and value.lower() not in PROFILE_ON:
+        return value
+    if value is not None or options.get('profile') is True:
+        return PROFILE_FILE
+    return None
+
+
+def reset_peak():
+    """Start measuring the peak memory of this process again, Linux only.
+    Returns False if it can't."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fw:
+            fw.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def get_peak():
+    """Return the peak resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/status', 'r') as fr:
+            return int(re.search(r'VmHWM:\s+(\d+)', fr.read()).group(1)) * 1024
+    except (IOError, OSError, AttributeError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def begin():
+    """Start profiling the image this process is going to reduce."""
+    global _stages
+    _stages = OrderedDict()
+    return {'start': time.time(), 'peak_reset': reset_peak()}
+
+
+def end(started):
+    """Return the profile of the image since `begin`, as a dict."""
+    global _stages
+    stages, _stages = _stages, None
+    return OrderedDict([
+        ('seconds', time.time() - started['start']),
+        ('stages', stages),
+        # without a reset it is the peak of the worker so far
+        ('peak_rss', get_peak()),
+        ('peak_per_file', started['peak_reset']),
+    ])
+
+
+class ProfileLog(object):
+    """Writes the profile of every `Result` to `filename` and sums them
+    up."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        makedirs(os.path.dirname(filename))
+        self.fw = open(filename, 'a')
+        self.images = 0
+        self.seconds = 0.0
+        self.stages = {}
+        self.peak = 0
+        self.peak_source = None
+
+    def add(self, result):
+        if not result.profile:
+            return
+        profile = result.profile
+        self.fw.write(json.dumps(OrderedDict([
+            ('source', result.source), ('status', result.status),
+            ('size', result.size)] + list(profile.items()))) + '\n')
+        self.images += 1
+        self.seconds += profile['seconds']
+        for name, seconds in profile['stages'].items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if profile['peak_rss'] > self.peak:
+            self.peak = profile['peak_rss']
+            self.peak_source = result.source
+
+    def close(self):
+        self.fw.close()
+
+    def summary(self):
+        """Return the time of every stage, and the biggest peak of memory,
+        as text."""
+        if self.images == 0:
+            return 'profile: no images'
+        total = max(self.seconds, 1e-6)
+        stages = ', '.join(
+            '{0} {1:.2f} s ({2:.0f}%)'.format(name, self.stages[name],
+                                             100.0 * self.stages[name] / total)
+            for name in STAGES if name in self.stages)
+        return 'profile: {0} images in {1:.2f} s of workers: {2}; peak ' \
+            '{3:.1f} MB ({4}), written to {5}'.format(
+                self.images, self.seconds, stages, self.peak / MB,
+                self.peak_source, self.filename)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import time
+from threading import Lock
+from .reducer import REDUCED
+from .reducer import DUPLICATE
+
+MB = 1048576.0
+
+
+class Progress(object):
+    """Counters of a batch, weighted by input bytes so a big image moves
+    the progress as much as many small ones. `add` is called from the
+    thread consuming the results, `snapshot` from any other."""
+
+    def __init__(self, total_images=0, total_bytes=0):
+        self.total_images = total_images
+        self.total_bytes = total_bytes
+        self.images = 0
+        self.bytes = 0
+        self.saved = 0
+        # bytes of the duplicates, not decoded again
+        self.deduplicated = 0
+        self.counts = {}
+        self.start = time.time()
+        self.lock = Lock()
+
+    def add(self, result):
+        with self.lock:
+            self.images += 1
+            self.bytes += result.size
+            self.counts[result.status] = \
+                self.counts.get(result.status, 0) + 1
+            if result.status in (REDUCED, DUPLICATE):
+                self.saved += result.size - result.dest_size
+            if result.status == DUPLICATE:
+                self.deduplicated += result.size
+
+    def snapshot(self):
+        """Return the counters, the throughput and the estimated seconds
+        left as a dict."""
+        with self.lock:
+            elapsed = max(time.time() - self.start, 1e-6)
+            if self.total_bytes > 0:
+                fraction = min(float(self.bytes) / self.total_bytes, 1.0)
+            else:
+                fraction = 1.0 if self.images >= self.total_images else 0.0
+            bytes_per_s = self.bytes / elapsed
+            if bytes_per_s > 0:
+                eta = (self.total_bytes - self.bytes) / bytes_per_s
+            else:
+                eta = None
+            return {
+                'images': self.images,
+                'total_images': self.total_images,
+                'bytes': self.bytes,
+                'total_bytes': self.total_bytes,
+                'fraction': fraction,
+                'elapsed': elapsed,
+                'images_per_s': self.images / elapsed,
+                'mb_per_s': bytes_per_s / MB,
+                'eta': eta,
+                'saved': self.saved,
+                'deduplicated': self.deduplicated,
+                'counts': dict(self.counts),
+            }
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return '--:--'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+    return '{0}:{1:02d}'.format(minutes, seconds)
+
+
+def format_progress(snapshot):
+    """One line summary of a `Progress.snapshot`."""
+    return '{0}/{1} images, {2:.1f} img/s, {3:.1f} MB/s, ETA {4}, ' \
+        'saved {5:.1f} MB'.format(snapshot['images'],
+                                  snapshot['total_images'],
+                                  snapshot['images_per_s'],
+                                  snapshot['mb_per_s'],
+                                  format_eta(snapshot['eta']),
+                                  snapshot['saved'] / MB)
+
+
+def format_summary(snapshot):
+    """Summary of a finished batch from a `Progress.snapshot`."""
+    counts = ', '.join('{0} {1}'.format(count, status) for status, count in
+                       sorted(snapshot['counts'].items()))
+    summary = '{0} images ({1}) in {2:.1f} s, {3:.1f} img/s, {4:.1f} MB/s, ' \
+        'saved {5:.1f} MB'.format(snapshot['images'], counts or 'none',
+                                  snapshot['elapsed'],
+                                  snapshot['images_per_s'],
+                                  snapshot['mb_per_s'],
+                                  snapshot['saved'] / MB)
+    if snapshot['counts'].get(DUPLICATE, 0) > 0:
+        summary += ', {0} duplicates not reduced again ({1:.1f} MB not ' \
+            'decoded)'.format(snapshot['counts'][DUPLICATE],
+                              snapshot['deduplicated'] / MB)
+    return summary
@@ -0,0 +1,653 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+import os
+import sys
+import time
+import signal
+import itertools
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from collections import namedtuple
+from threading import Lock
+from threading import Condition
+from threading import Thread
+from multiprocessing import Pool
+from multiprocessing import cpu_count
+try:
+    from multiprocessing import get_context
+except ImportError:
+    get_context = None
+try:
+    from multiprocessing import SimpleQueue
+except ImportError:
+    from multiprocessing.queues import SimpleQueue
+from PIL import Image
+from .image import KEEP
+from .image import COPY
+from .image import get_job
+from .image import get_dest
+from .image import get_dests
+from .image import get_action
+from .image import copy_image
+from .image import probe_image
+from .image import estimate_memory
+from .image import reduce_image
+from .archive import Archive
+from .files import collect
+from .files import get_size
+from .files import get_collected
+from .files import clone_file
+from .manifest import Manifest
+from .manifest import get_digest
+from .manifest import get_fingerprint
+from .profiling import begin
+from .profiling import end
+from .profiling import is_profiling
+
+EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# jobs queued per worker, so a long stream of files is never held in memory
+JOBS_PER_WORKER = 4
+# seconds the worker of a job must be gone to give the job up, its result
+# may still be on its way
+LOST_AFTER = 1.0
+
+REDUCED = 'reduced'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+# already fit, see `get_action`. Copied to their destination, or left
+# unchanged where they were
+COPIED = 'copied'
+UNCHANGED = 'unchanged'
+# same content as another file of the batch, its files were made from the
+# ones of that file, see `Duplicates`
+DUPLICATE = 'duplicate'
+
+# size is the size of the source before it was reduced, dest_size the size
+# of what was written. dest is the file written, or the first rendition,
+# dests all of them, or their names under the archive when writing one.
+# profile is None unless profiling, see profiling.py
+Result = namedtuple('Result', ['source', 'dest', 'size', 'status', 'error',
+                               'dest_size', 'dests', 'profile'])
+
+# tokens of the jobs queued by this process, see `run_job`
+_tokens = itertools.count()
+# where a worker tells the pid it runs every job with, see `make_pool`
+_started = None
+
+
+def get_workers(workers=0):
+    """Return the number of worker processes, `0` means one per core."""
+    if workers > 0:
+        return workers
+    try:
+        return cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def get_memory_budget(memory_mb=0):
+    """Return the bytes the jobs in flight may use, `0` means half of the
+    physical memory."""
+    if memory_mb > 0:
+        return memory_mb * 1048576
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError, AttributeError):
+        return 1024 * 1048576
+
+
+def get_max_pixels(options):
+    """Return the pixels of the biggest image `options` let be reduced,
+    None if there is no limit."""
+    return int(options.get('max_megapixels', 0) * 1000000) or None
+
+
+def init_worker(max_pixels, started=None):
+    global _started
+    _started = started
+    # the images over max_pixels are rejected before their jobs are
+    # queued, Pillow's own check is what stops a header lying about them
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    # interrupting is up to the parent, it terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def read_started(started, pids):
+    for token, pid in iter(started.get, None):
+        pids[token] = pid
+
+
+def is_embedded():
+    """Return if this process isn't python itself but embeds it, like
+    Nautilus does."""
+    return 'python' not in os.path.basename(sys.executable or '')
+
+
+def get_python():
+    """Return the python interpreter of the version running this process.
+    Inside Nautilus sys.executable isn't python, it is looked for in the
+    PATH then. None if there is none."""
+    if not is_embedded():
+        return sys.executable
+    for name in ('python{0}.{1}'.format(*sys.version_info[:2]),
+                 'python{0}'.format(sys.version_info[0])):
+        for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            python = os.path.join(directory, name)
+            if os.path.isfile(python) and os.access(python, os.X_OK):
+                return python
+    return None
+
+
+def get_pool_context():
+    """Return the multiprocessing context to start the workers with, None
+    for the default one.
+
+    Forking Nautilus, threads and all, leaves the workers with locks
+    held by threads that don't exist in them. Inside it the workers are
+    forked from a forkserver, a fresh python, when there is one. Python 2
+    has no forkserver, see `DoItInBackground`."""
+    if get_context is None or not is_embedded():
+        return None
+    python = get_python()
+    if python is None:
+        return None
+    context = get_context('forkserver')
+    context.set_executable(python)
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+def make_pool(workers, max_pixels=None):
+    """Return a pool of `workers` processes, see `init_worker`.
+
+    A worker killed, by the OOM killer for instance, takes the job it was
+    running with it and the pool never reports it. So every job tells
+    the pid of its worker when it starts, and `pool.started` maps the
+    token of the job to it, see `Reducer.find_lost`."""
+    context = get_pool_context()
+    if context is None:
+        started = SimpleQueue()
+        pool = Pool(workers, init_worker, (max_pixels, started))
+    else:
+        started = context.SimpleQueue()
+        pool = context.Pool(workers, init_worker, (max_pixels, started))
+    pool.started = {}
+    pool.started_queue = started
+    thread = Thread(target=read_started, args=(started, pool.started))
+    thread.daemon = True
+    thread.start()
+    return pool
+
+
+def close_pool(pool):
+    """Terminate a pool made by `make_pool`."""
+    pool.terminate()
+    pool.started_queue.put(None)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def iter_images(paths, recursive=True):
+    """Yield the image files in `paths`, walking directories lazily."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for afile in sorted(files):
+                    if afile.lower().endswith(EXTENSIONS):
+                        yield os.path.join(root, afile)
+                if recursive is False:
+                    break
+        elif os.path.isfile(path):
+            yield path
+
+
+def reduce_job(job):
+    """Run `reduce_image` in a worker process.
+
+    `job` is the tuple of `reduce_image` arguments. Returns the tuple
+    (originalFile, destFiles, size, error, dest_size, status) where error
+    is None on success, so one broken image doesn't abort the whole
+    batch."""
+    originalFile = job[0]
+    size = 0
+    try:
+        size = os.path.getsize(originalFile)
+        destFiles = reduce_image(*job)
+        if not isinstance(destFiles, list):
+            destFiles = [destFiles]
+        return originalFile, destFiles, size, None, sum(
+            get_size(destFile) for destFile in destFiles), REDUCED
+    except Exception as e:
+        return originalFile, [], size, str(e), 0, FAILED
+
+
+def copy_job(job):
+    """Run `copy_image` in a worker process, `job` is (originalFile,
+    destFile). Returns the same tuple as `reduce_job`."""
+    originalFile, destFile = job
+    size = 0
+    try:
+        size = os.path.getsize(originalFile)
+        copy_image(originalFile, destFile)
+        return originalFile, [destFile], size, None, size, COPIED
+    except Exception as e:
+        return originalFile, [], size, str(e), 0, FAILED
+
+
+def run_job(function, job, profile=False, archive=False, token=None):
+    """Run `function(job)` in a worker process. Returns its tuple with the
+    profile of the job added, None if `profile` is off, and with
+    `archive` the (filename, data) of the files it would have written,
+    None otherwise."""
+    if _started is not None and token is not None:
+        _started.put((token, os.getpid()))
+    started = None
+    if profile is True:
+        started = begin()
+    if archive is True:
+        collect()
+    try:
+        result = function(job)
+    finally:
+        written = get_collected() if archive is True else None
+    return result + (None if started is None else end(started), written)
+
+
+class Budget(object):
+    """Bytes of memory the jobs in flight may use, it can be shared by
+    reducers running at once in the same pool."""
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.used = 0
+        self.changed = Condition(Lock())
+
+    def try_take(self, memory):
+        """Take `memory` if it fits, or if nothing is in flight, then a job
+        bigger than the budget runs alone. Returns if it was taken."""
+        with self.changed:
+            if memory > 0 and self.used > 0 and \
+                    self.used + memory > self.memory:
+                return False
+            self.used += memory
+            return True
+
+    def give(self, memory):
+        with self.changed:
+            self.used -= memory
+            self.changed.notify_all()
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for memory to be given back."""
+        with self.changed:
+            self.changed.wait(timeout)
+
+
+class Duplicates(object):
+    """Files of a batch with the same content as one seen before, the
+    original.
+
+    Files are only compared to the ones of the same size, and then by
+    their digest, so most of them are never read. A file changed since it
+    was seen, reduced over itself for instance, is no longer an original.
+    The duplicates of an original still being reduced wait for it."""
+
+    def __init__(self):
+        # (file, mtime) of the originals, by size and key
+        self.originals = {}
+        self.digests = {}
+        # (file, dests) of the duplicates by original, and the `Result` of
+        # the originals done
+        self.waiting = {}
+        self.results = {}
+
+    def get_digest(self, afile, mtime):
+        """Return the digest of `afile`, None if changed since `mtime`."""
+        if afile not in self.digests:
+            try:
+                if os.stat(afile).st_mtime != mtime:
+                    return None
+                self.digests[afile] = get_digest(afile)
+            except (IOError, OSError):
+                return None
+        return self.digests[afile]
+
+    def find(self, afile, key):
+        """Return the original with the content of `afile` that was seen
+        with the same `key`, None if there is none, then `afile` is an
+        original from now on."""
+        stat = os.stat(afile)
+        originals = self.originals.setdefault((stat.st_size, key), [])
+        if originals:
+            digest = self.get_digest(afile, stat.st_mtime)
+            for original, mtime in originals:
+                if digest is not None and original != afile and \
+                        self.get_digest(original, mtime) == digest:
+                    return original
+        if (afile, stat.st_mtime) not in originals:
+            originals.append((afile, stat.st_mtime))
+        return None
+
+
+class Reducer(object):
+    """Reduces a stream of files with `options` in a pool of worker
+    processes, see `read_config` for the options.
+
+    Before a job is queued the header of its image is probed. Images that
+    need no work are copied through or left as they are, see
+    `get_action`. For the rest the dimensions are used to estimate the
+    memory they need. Jobs are only admitted while the jobs in flight, of
+    every reducer sharing the budget, fit in it, an image bigger than the
+    budget runs alone, and images over `max_megapixels` are rejected.
+
+    With the 'archive' option the images are written into that archive,
+    see archive.py, and the manifest is not used, every image is put into
+    it. Images that need no work are copied into it.
+
+    With the 'dedupe' option a file with the same content as another one
+    of the same `run` is not reduced again, its files are reflinked, hard
+    linked or copied from the ones of the other, see `Duplicates`.
+
+    By default every `run` has a pool, a budget and a manifest of its own.
+    The daemon passes the ones it shares among all its clients instead,
+    then `workers` must be the size of `pool` and the manifest is saved
+    by its owner, `run` only journals it."""
+
+    def __init__(self, options, workers=0, pool=None, budget=None,
+                 manifest=None):
+        self.options = options
+        self.workers = get_workers(workers or options.get('workers', 0))
+        self.pool = pool
+        self.budget = budget
+        if budget is None:
+            self.budget = Budget(get_memory_budget(
+                options.get('memory_mb', 0)))
+        self.max_pixels = get_max_pixels(options) or 0
+        self.fingerprint = get_fingerprint(options)
+        self.profile = is_profiling(options)
+        self.manifest = None
+        self.save_manifest = manifest is None
+        self.archive = None
+        if options.get('cache') is True and not options.get('archive'):
+            self.manifest = manifest or Manifest(
+                use_digest=options.get('cache_hash'))
+        self.stopit = False
+
+    def stop(self, *args):
+        self.stopit = True
+
+    def estimate(self, probe):
+        """Return the (pixels, bytes) of the job of the image of `probe`,
+        (0, 0) if it couldn't be probed, then the worker reports why."""
+        if probe is None:
+            return 0, 0
+        boxes = self.options.get('renditions') or [self.options]
+        return estimate_memory(probe, max(box['width'] for box in boxes),
+                               max(box['height'] for box in boxes),
+                               min(box['border_width'] for box in boxes),
+                               self.options['resampling'])
+
+    def get_task(self, element, probe):
+        """Return the (function, job) to run in a worker for `element`,
+        None if it is to be left unchanged."""
+        action = None
+        if probe is not None:
+            action = get_action(element, probe, self.options)
+        if action == KEEP and self.archive is None:
+            return None
+        if action in (KEEP, COPY):
+            return copy_job, (element, get_dest(element,
+                                                self.options['tojpeg'],
+                                                self.options['overwrite'],
+                                                self.options['format']))
+        return reduce_job, get_job(element, self.options)
+
+    def get_dests(self, element, task):
+        """Return the files `task` writes for `element`."""
+        if task[0] is copy_job:
+            return [task[1][1]]
+        return get_dests(element, self.options)
+
+    def run(self, elements):
+        """Yield a `Result` for every file in `elements` as soon as it is
+        done, in completion order. `elements` is consumed lazily."""
+        if self.options.get('archive'):
+            self.archive = Archive(self.options['archive'])
+        results = queue.Queue()
+        pool = self.pool
+        if pool is None:
+            pool = make_pool(self.workers, self.max_pixels or None)
+        # estimated bytes of the jobs in flight, by file, and their files by
+        # token
+        admitted = {}
+        tokens = {}
+        duplicates = None
+        if self.options.get('dedupe') is True and self.archive is None:
+            duplicates = Duplicates()
+        try:
+            for element in elements:
+                if self.stopit is True:
+                    return
+                if self.manifest is not None and \
+                        self.manifest.is_reduced(element, self.fingerprint):
+                    yield Result(element, None, os.path.getsize(element),
+                                 SKIPPED, None, 0, [], None)
+                    continue
+                try:
+                    probe = probe_image(element)
+                except Exception as e:
+                    if os.path.exists(element):
+                        # it can't be decoded either, and its memory is
+                        # unknown
+                        yield Result(element, None, os.path.getsize(element),
+                                     FAILED, str(e), 0, [], None)
+                        continue
+                    # the job reports it is gone
+                    probe = None
+                pixels, memory = self.estimate(probe)
+                if self.max_pixels > 0 and pixels > self.max_pixels:
+                    yield Result(element, None, os.path.getsize(element),
+                                 FAILED, 'image too large: {0} MP'.format(
+                                     pixels // 1000000), 0, [], None)
+                    continue
+                task = self.get_task(element, probe)
+                if task is None:
+                    yield self.add_result(element, [element],
+                                          os.path.getsize(element), None,
+                                          os.path.getsize(element), UNCHANGED)
+                    continue
+                if duplicates is not None:
+                    dests = self.get_dests(element, task)
+                    # same content, same job and same output formats
+                    try:
+                        original = duplicates.find(element, (task[0],) + tuple(
+                            os.path.splitext(dest)[1].lower()
+                            for dest in dests))
+                    except OSError:
+                        # the job reports it
+                        original = None
+                    if original is not None:
+                        duplicates.waiting.setdefault(original, []).append(
+                            (element, dests))
+                        if original in duplicates.results:
+                            for result in self.get_results(
+                                    duplicates.results[original],
+                                    duplicates):
+                                yield result
+                        continue
+                if task[0] is copy_job:
+                    # nothing is decoded
+                    memory = 0
+                while len(admitted) >= self.workers * JOBS_PER_WORKER or \
+                        element in admitted or \
+                        not self.budget.try_take(memory):
+                    if not admitted:
+                        # the budget is used by the jobs of other reducers
+                        # sharing it, see the daemon
+                        if self.stopit is True:
+                            return
+                        self.budget.wait(0.2)
+                        continue
+                    result = self.get_result(results, tokens, pool)
+                    if result is None:
+                        return
+                    self.budget.give(admitted.pop(result.source, 0))
+                    for result in self.get_results(result, duplicates):
+                        yield result
+                token = next(_tokens)
+                pool.apply_async(run_job, (task[0], task[1], self.profile,
+                                           self.archive is not None, token),
+                                 callback=lambda result, token=token:
+                                 results.put((token, result)))
+                tokens[token] = element
+                admitted[element] = memory
+            while admitted:
+                result = self.get_result(results, tokens, pool)
+                if result is None:
+                    return
+                self.budget.give(admitted.pop(result.source, 0))
+                for result in self.get_results(result, duplicates):
+                    yield result
+        finally:
+            self.budget.give(sum(admitted.values()))
+            if getattr(pool, 'started', None) is not None:
+                for token in tokens:
+                    pool.started.pop(token, None)
+            if self.pool is None:
+                close_pool(pool)
+            if self.manifest is not None and self.save_manifest is True:
+                try:
+                    self.manifest.save()
+                except Exception as e:
+                    sys.stderr.write('{0}\n'.format(e))
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+
+    def get_results(self, result, duplicates=None):
+        """Return the results of a job done, `result`, and of the
+        duplicates of its source waiting for it."""
+        if duplicates is None:
+            return [result]
+        if result.source in duplicates.results:
+            results = []
+        else:
+            duplicates.results[result.source] = result
+            results = [result]
+        for element, dests in duplicates.waiting.pop(result.source, []):
+            results.append(self.copy_result(element, dests, result))
+        return results
+
+    def copy_result(self, element, dests, result):
+        """Return the `Result` of `element`, whose source is the same as
+        the one of `result`, making its `dests` from the files of
+        `result`."""
+        size = os.path.getsize(element)
+        if result.status == FAILED:
+            return Result(element, None, size, FAILED, result.error, 0, [],
+                          None)
+        # the originals of the user are never hard linked, an edit of one
+        # would change the other
+        originals = (element, result.source)
+        try:
+            for source, dest in zip(result.dests, dests):
+                if source != dest:
+                    clone_file(source, dest, hardlink=(
+                        self.options['overwrite'] is not True and
+                        source not in originals and dest not in originals))
+        except (IOError, OSError) as e:
+            return Result(element, None, size, FAILED, str(e), 0, [], None)
+        return self.add_result(element, dests, size, None, result.dest_size,
+                               DUPLICATE)
+
+    def get_result(self, results, tokens, pool):
+        """Wait for the next finished job of the ones in `tokens`, None if
+        stopped meanwhile. A job whose worker is gone fails."""
+        # when the worker of every job was first seen gone
+        gone = {}
+        while self.stopit is False:
+            try:
+                token, result = results.get(timeout=0.2)
+            except queue.Empty:
+                token = self.find_lost(tokens, pool, gone)
+                if token is None:
+                    continue
+                element = tokens.pop(token)
+                pool.started.pop(token, None)
+                return Result(element, None, os.path.getsize(element)
+                              if os.path.exists(element) else 0, FAILED,
+                              'the worker reducing it died', 0, [], None)
+            if tokens.pop(token, None) is None:
+                # given up already
+                continue
+            if getattr(pool, 'started', None) is not None:
+                pool.started.pop(token, None)
+            return self.add_result(*result)
+        return None
+
+    def find_lost(self, tokens, pool, gone):
+        """Return the token of a job in `tokens` whose worker has been gone
+        for LOST_AFTER seconds, None if there is none. Only the pools of
+        `make_pool` tell."""
+        started = getattr(pool, 'started', None)
+        if started is None:
+            return None
+        now = time.time()
+        for token in tokens:
+            pid = started.get(token)
+            if pid is None or is_alive(pid):
+                continue
+            if now - gone.setdefault(token, now) >= LOST_AFTER:
+                return token
+        return None
+
+    def add_result(self, element, destFiles, size, error, dest_size,
+                   status, profile=None, written=None):
+        """Return the `Result` of a job, remembering its files in the
+        manifest, or putting them into the archive."""
+        if error is not None:
+            return Result(element, None, size, FAILED, error, 0, [],
+                          profile)
+        if self.archive is not None:
+            destFiles = [self.archive.add(destFile, data)
+                         for destFile, data in written]
+        if self.manifest is not None:
+            # remember the outputs too, so they are not reduced again
+            try:
+                for destFile in destFiles:
+                    self.manifest.add(destFile, self.fingerprint)
+                if element not in destFiles and os.path.exists(element):
+                    self.manifest.add(element, self.fingerprint, destFiles)
+            except OSError as e:
+                sys.stderr.write('{0}\n'.format(e))
+        return Result(element, destFiles[0], size, status, None, dest_size,
+                      destFiles, profile)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of nautilus-reduceimages
+#
+# Copyright (C) 2017 Lorenzo Carbonell
+# lorenzo.carbonell.cerezo@gmail.com
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+#
+"""Watch directories and reduce the images dropped in them.
+
+A file is reduced once it has been quiet for a while: SETTLE seconds
+after it was closed or moved in, or `quiet_seconds` after it was last
+written if its writer doesn't close it. Ready files are reduced a few at
+a time, in one warm pool. The files already in the directories are
+reduced on start, the manifest skips the ones a previous run handled.
+
+Changes are read from inotify through libc, without it the directories
+are scanned every `quiet_seconds`."""
+import os
+import sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+from .reducer import SKIPPED
+from .reducer import EXTENSIONS
+from .reducer import JOBS_PER_WORKER
+from .reducer import Reducer
+from .reducer import make_pool
+from .reducer import close_pool
+from .reducer import get_max_pixels
+from .reducer import iter_images
+from .reducer import get_workers
+from .manifest import Manifest
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT = struct.Struct('iIII')
+# seconds a closed file waits, in case it is opened again
+SETTLE = 1.0
+# seconds between manifest saves, the journal has everything meanwhile
+SAVE_INTERVAL = 300
+
+
+def is_image(afile):
+    return afile.lower().endswith(EXTENSIONS)
+
+
+def fsencode(afile):
+    if isinstance(afile, bytes):
+        return afile
+    return afile.encode(sys.getfilesystemencoding())
+
+
+def fsdecode(afile):
+    if sys.version_info[0] < 3:
+        return afile
+    return afile.decode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+class InotifyWatcher(object):
+    """Changes of the files in some directories, from inotify."""
+
+    def __init__(self, directories, recursive=True):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.recursive = recursive
+        self.directories = {}
+        for directory in directories:
+            self.add(directory)
+
+    def add(self, directory):
+        """Watch `directory`, and its subdirectories if recursive, and
+        return the images already there."""
+        wd = self.libc.inotify_add_watch(self.fd, fsencode(directory),
+                                         WATCH_MASK)
+        if wd < 0:
+            sys.stderr.write('Can not watch {0}\n'.format(directory))
+            return []
+        self.directories[wd] = directory
+        files = []
+        for name in sorted(os.listdir(directory)):
+            afile = os.path.join(directory, name)
+            if os.path.isdir(afile):
+                if self.recursive is True:
+                    files += self.add(afile)
+            elif is_image(name):
+                files.append(afile)
+        return files
+
+    def read(self, timeout):
+        """Wait up to `timeout` seconds and return the (file, closed) of
+        the images changed, `closed` is True once the writer is done."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        changes = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length]
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, look at everything again
+                for directory in list(self.directories.values()):
+                    changes += [(afile, True) for afile in
+                                iter_images([directory], False)]
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            afile = os.path.join(directory, fsdecode(name.rstrip(b'\0')))
+            if mask & IN_ISDIR:
+                if self.recursive is True and \
+                        mask & (IN_CREATE | IN_MOVED_TO):
+                    # files moved in with the directory have no events
+                    changes += [(image, True) for image in self.add(afile)]
+            elif is_image(afile):
+                changes.append(
+                    (afile, bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))))
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Changes of the files in some directories, scanning them."""
+
+    def __init__(self, directories, recursive=True):
+        self.directories = directories
+        self.recursive = recursive
+        self.stats = {}
+        self.scan()
+
+    def scan(self):
+        """Return the images that are new or changed since the last scan."""
+        changes = []
+        for afile in iter_images(self.directories, self.recursive):
+            try:
+                stat = os.stat(afile)
+            except OSError:
+                continue
+            if self.stats.get(afile) != (stat.st_size, stat.st_mtime):
+                self.stats[afile] = (stat.st_size, stat.st_mtime)
+                changes.append(afile)
+        return changes
+
+    def read(self, timeout):
+        time.sleep(timeout)
+        return [(afile, False) for afile in self.scan()]
+
+    def close(self):
+        pass
+
+
+def get_watcher(directories, recursive=True):
+    """Return the watcher of `directories` and the images already there."""
+    try:
+        watcher = InotifyWatcher([], recursive)
+    except (OSError, AttributeError, TypeError) as e:
+        sys.stderr.write('No inotify, scanning: {0}\n'.format(e))
+        watcher = PollingWatcher(directories, recursive)
+        return watcher, sorted(watcher.stats)
+    files = []
+    for directory in directories:
+        files += watcher.add(os.path.abspath(directory))
+    return watcher, files
+
+
+def watch(directories, options, recursive=True):
+    """Reduce the images written to `directories` with `options`, and the
+    ones already there, and yield their `Result`, but for the skipped
+    ones, until interrupted. `options['cache']` is always on, it keeps
+    the images reduced before a restart, and what was written, from
+    being reduced again."""
+    options = dict(options, cache=True)
+    quiet = max(options.get('quiet_seconds', 0), SETTLE)
+    watcher, files = get_watcher(directories, recursive)
+    now = time.time()
+    # when every file waiting was last changed and if it was closed
+    pending = dict((afile, (now - quiet, True)) for afile in files)
+    manifest = Manifest(use_digest=options.get('cache_hash'))
+    workers = get_workers(options.get('workers', 0))
+    pool = make_pool(workers, get_max_pixels(options))
+    reducer = Reducer(options, workers, pool, manifest=manifest)
+    saved = now
+    try:
+        while True:
+            for afile, closed in watcher.read(SETTLE if pending else quiet):
+                pending[afile] = (time.time(), closed)
+            now = time.time()
+            ready = sorted(afile for afile, (changed, closed) in
+                           pending.items()
+                           if now - changed >= (SETTLE if closed else quiet))
+            batch = ready[:workers * JOBS_PER_WORKER]
+            for afile in batch:
+                del pending[afile]
+            for result in reducer.run([afile for afile in batch
+                                       if os.path.isfile(afile)]):
+                if result.status != SKIPPED:
+                    yield result
+            if now - saved > SAVE_INTERVAL and not pending:
+                manifest.save()
+                saved = now
+    finally:
+        close_pool(pool)
+        watcher.close()
+        manifest.save()